@@ -1,6 +1,8 @@
 # Fetches and displays a basic candlestick app.
 
+import os
 import dash
+from dash.exceptions import PreventUpdate
 import plotly.graph_objects as go
 import plotly.express as px
 import dash_core_components as dcc
@@ -11,13 +13,72 @@ from datetime import date, timedelta
 from math import ceil
 from backtest import *
 from bloomberg_functions import req_historical_data
+from charts import candlestick_figure, relayout_x_range, yield_surface_figure
+from feature_store import FeatureStore
+from jobs import JobManager, JobProgress
+from persistence import new_run_dir, write_results
+from pipeline import BacktestPipeline
+from result_cache import ResultCache
+from table_query import query_frame
+from yield_store import YieldStore
+from profiling import StageProfiler, NULL_PROFILER
 import numpy as np
-from sklearn import linear_model
-from statistics import mean
 
 # Create a Dash app
 app = dash.Dash(__name__)
 
+# Set the BACKTEST_RESULTS_DIR environment variable to save every backtest's
+# results to a new folder inside it. Files are written in the background.
+RESULTS_DIR = os.environ.get('BACKTEST_RESULTS_DIR')
+
+# Set the PROFILE_BACKTEST environment variable to show how long each stage of
+# the backtest took (and how much memory it used) under the date range.
+PROFILE_BACKTEST = bool(os.environ.get('PROFILE_BACKTEST'))
+
+# Set the FEATURE_STORE_DIR environment variable to keep the features and
+# responses of past backtests there (up to FEATURE_STORE_MB megabytes), so
+# that rerunning on the same data with other parameters can reuse them.
+if os.environ.get('FEATURE_STORE_DIR'):
+    FEATURE_STORE = FeatureStore(
+        os.environ['FEATURE_STORE_DIR'],
+        max_bytes=int(os.environ.get('FEATURE_STORE_MB', 1024)) * 2 ** 20
+    )
+else:
+    FEATURE_STORE = None
+
+# Remembers the last backtest on each of the PIPELINE_INPUTS most recently
+# used pairs of histories, so that changing a parameter only recomputes the
+# stages that depend on it.
+PIPELINE = BacktestPipeline(
+    feature_store=FEATURE_STORE,
+    max_inputs=int(os.environ.get('PIPELINE_INPUTS', 8))
+)
+
+# Histories and backtest results stay on the server; the hidden divs below
+# only hold their keys in CACHE. Set RESULT_CACHE_ENTRIES to keep more or
+# fewer of them around.
+CACHE = ResultCache(
+    max_entries=int(os.environ.get('RESULT_CACHE_ENTRIES', 32))
+)
+
+# Backtests run as background jobs, polled by the page every POLL_MS
+# milliseconds for progress; up to BACKTEST_WORKERS of them at once.
+JOBS = JobManager(max_workers=int(os.environ.get('BACKTEST_WORKERS', 4)))
+POLL_MS = 500
+
+# Treasury CMT rates are read from a local copy that only refreshes the
+# current year, at most once a day.
+YIELD_STORE = YieldStore()
+
+# Rows per page of the result tables, which are paged, sorted and filtered on
+# the server.
+PAGE_SIZE = 50
+RESULT_TABLE_OPTIONS = dict(
+    page_action='custom', page_current=0, page_size=PAGE_SIZE,
+    sort_action='custom', sort_mode='multi', sort_by=[],
+    filter_action='custom', filter_query=''
+)
+
 # Create the page layout
 app.layout = html.Div([
     html.H1(
@@ -183,6 +244,7 @@ app.layout = html.Div([
                                 html.Td(
                                     dcc.Input(
                                         id='lil-n', type="number", value=5,
+                                        debounce=True,
                                         style={'text-align': 'center',
                                                'width': '30px'}
                                     )
@@ -190,6 +252,7 @@ app.layout = html.Div([
                                 html.Td(
                                     dcc.Input(
                                         id='big-N', type="number", value=10,
+                                        debounce=True,
                                         style={'text-align': 'center',
                                                'width': '50px'}
                                     )
@@ -197,6 +260,7 @@ app.layout = html.Div([
                                 html.Td(
                                     dcc.Input(
                                         id="alpha", type="number", value=0.02,
+                                        debounce=True,
                                         style={'text-align': 'center',
                                                'width': '50px'}
                                     )
@@ -204,6 +268,7 @@ app.layout = html.Div([
                                 html.Td(
                                     dcc.Input(
                                         id="lot-size", type="number", value=100,
+                                        debounce=True,
                                         style={'text-align': 'center',
                                                'width': '50px'}
                                     )
@@ -211,7 +276,7 @@ app.layout = html.Div([
                                 html.Td(
                                     dcc.Input(
                                         id="starting-cash", type="number",
-                                        value=50000,
+                                        value=50000, debounce=True,
                                         style={'text-align': 'center',
                                                'width': '100px'}
                                     )
@@ -229,12 +294,17 @@ app.layout = html.Div([
             'display': 'inline-block', 'width': '50%', 'vertical-align': 'top'
         }
     ),
-    ##### Intermediate Variables (hidden in divs as JSON) ######################
+    ##### Intermediate Variables (hidden in divs as CACHE keys) ################
     ############################################################################
-    # Hidden div inside the app that stores IVV historical data
+    # Hidden div inside the app that stores the key of IVV historical data
     html.Div(id='ivv-hist', style={'display': 'none'}),
-    # Hidden div inside the app that stores bonds historical data
+    # Hidden div inside the app that stores the key of bonds historical data
     html.Div(id='bonds-hist', style={'display': 'none'}),
+    # Hidden div inside the app that stores the key of the backtest results
+    html.Div(id='backtest-run', style={'display': 'none'}),
+    # Hidden div inside the app that stores the ID of the running backtest
+    html.Div(id='backtest-job', style={'display': 'none'}),
+    dcc.Interval(id='backtest-poll', interval=POLL_MS, disabled=True),
     ############################################################################
     ############################################################################
     html.Div(
@@ -243,6 +313,10 @@ app.layout = html.Div([
     ),
     # Display the current selected date range
     html.Div(id='date-range-output'),
+    # What the running backtest is doing
+    html.Div(id='backtest-progress'),
+    # Stage timings of the last backtest, if PROFILE_BACKTEST is set
+    html.Div(id='backtest-profile'),
     html.Div([
         html.H2(
             'Trade Ledger',
@@ -255,7 +329,8 @@ app.layout = html.Div([
             id='trade-ledger',
             fixed_rows={'headers': True},
             style_cell={'textAlign': 'center'},
-            style_table={'height': '300px', 'overflowY': 'auto'}
+            style_table={'height': '300px', 'overflowY': 'auto'},
+            **RESULT_TABLE_OPTIONS
         )
     ]),
     html.Div([
@@ -280,7 +355,8 @@ app.layout = html.Div([
                 id='calendar-ledger',
                 fixed_rows={'headers': True},
                 style_cell={'textAlign': 'center'},
-                style_table={'height': '300px', 'overflowY': 'auto'}
+                style_table={'height': '300px', 'overflowY': 'auto'},
+                **RESULT_TABLE_OPTIONS
             ),
             style={'display': 'inline-block', 'width': '45%'}
         ),
@@ -289,7 +365,8 @@ app.layout = html.Div([
                 id='blotter',
                 fixed_rows={'headers': True},
                 style_cell={'textAlign': 'center'},
-                style_table={'height': '300px', 'overflowY': 'auto'}
+                style_table={'height': '300px', 'overflowY': 'auto'},
+                **RESULT_TABLE_OPTIONS
             ),
             style={'display': 'inline-block', 'width': '55%'}
         )
@@ -306,7 +383,8 @@ app.layout = html.Div([
             id='features-and-responses',
             fixed_rows={'headers': True},
             style_cell={'textAlign': 'center'},
-            style_table={'height': '300px', 'overflowY': 'auto'}
+            style_table={'height': '300px', 'overflowY': 'auto'},
+            **RESULT_TABLE_OPTIONS
         )
     ]),
     html.Div([
@@ -329,7 +407,6 @@ app.layout = html.Div([
     #### Update Historical Bloomberg Data
     [dash.dependencies.Output('ivv-hist', 'children'),
      dash.dependencies.Output('date-range-output', 'children'),
-     dash.dependencies.Output('candlestick', 'figure'),
      dash.dependencies.Output('candlestick', 'style')],
     dash.dependencies.Input("run-backtest", 'n_clicks'),
     [dash.dependencies.State("bbg-identifier-1", "value"),
@@ -364,24 +441,40 @@ def update_bbg_data(nclicks, bbg_id_1, N, n, start_date, end_date):
     if len(date_output_msg) == len('You have selected: '):
         date_output_msg = 'Select a date to see it displayed here'
 
-    fig = go.Figure(
-        data=[
-            go.Candlestick(
-                x=historical_data['Date'],
-                open=historical_data['Open'],
-                high=historical_data['High'],
-                low=historical_data['Low'],
-                close=historical_data['Close']
-            )
-        ]
-    )
+    return CACHE.put(historical_data), date_output_msg, {'display': 'block'}
+
+
+def zoomed_range(relayout_data, data_id):
+    # The date range zoomed to on the candlestick, unless it's new data
+    #   (from data_id) that triggered the callback.
+    triggered = [t['prop_id'] for t in dash.callback_context.triggered]
+    if any(t.startswith(data_id + '.') for t in triggered):
+        return None
+    if not any(key.startswith('xaxis.') for key in relayout_data or {}):
+        # Some other change to the layout, e.g. autosize
+        raise PreventUpdate
+    return relayout_x_range(relayout_data)
 
-    return historical_data.to_json(), date_output_msg, fig, {'display': 'block'}
+
+@app.callback(
+    dash.dependencies.Output('candlestick', 'figure'),
+    [dash.dependencies.Input('ivv-hist', 'children'),
+     dash.dependencies.Input('candlestick', 'relayoutData')],
+    prevent_initial_call=True
+)
+def update_candlestick(ivv_hist, relayout_data):
+    # Redrawn at a level of detail to suit the zoomed-in date range
+    historical_data = CACHE.get(ivv_hist)
+    if historical_data is None:
+        raise PreventUpdate
+    historical_data = to_history_frame(historical_data)
+    return candlestick_figure(
+        historical_data, zoomed_range(relayout_data, 'ivv-hist')
+    )
 
 
 @app.callback(
     [dash.dependencies.Output('bonds-hist', 'children'),
-     dash.dependencies.Output('bonds-3d-graph', 'figure'),
      dash.dependencies.Output('bonds-3d-graph', 'style')],
     dash.dependencies.Input("run-backtest", 'n_clicks'),
     [dash.dependencies.State('hist-data-range', 'start_date'),
@@ -399,61 +492,69 @@ def update_bonds_hist(n_clicks, startDate, endDate, N, n):
     )
     startDate = startDate.strftime("%Y-%m-%d")
 
-    data_years = list(
-        range(pd.to_datetime(startDate).date().year,
-              pd.to_datetime(endDate).date().year + 1, 1)
-    )
+    bonds_data = YIELD_STORE.rates(startDate, endDate)
 
-    bonds_data = fetch_usdt_rates(data_years[0])
-
-    if len(data_years) > 1:
-        for year in data_years[1:]:
-            bonds_data = pd.concat([bonds_data, fetch_usdt_rates(year)],
-                                   axis=0, ignore_index=True)
-
-    # How to filter a dataframe for rows that you want
-    bonds_data = bonds_data[bonds_data.Date >= pd.to_datetime(startDate)]
-    bonds_data = bonds_data[bonds_data.Date <= pd.to_datetime(endDate)]
-
-    fig = go.Figure(
-        data=[
-            go.Surface(
-                z=bonds_data,
-                y=bonds_data.Date,
-                x=[
-                    to_years(cmt_colname) for cmt_colname in list(
-                        filter(lambda x: ' ' in x, bonds_data.columns.values)
-                    )
-                ]
-            )
-        ]
-    )
+    return CACHE.put(bonds_data), {'display': 'block'}
 
-    fig.update_layout(
-        scene=dict(
-            xaxis_title='Maturity (years)',
-            yaxis_title='Date',
-            zaxis_title='APR (%)',
-            zaxis=dict(ticksuffix='%')
-        )
+
+@app.callback(
+    dash.dependencies.Output('bonds-3d-graph', 'figure'),
+    [dash.dependencies.Input('bonds-hist', 'children'),
+     dash.dependencies.Input('candlestick', 'relayoutData')],
+    prevent_initial_call=True
+)
+def update_bonds_surface(bonds_hist, relayout_data):
+    # Follows the date range zoomed to on the candlestick
+    bonds_data = CACHE.get(bonds_hist)
+    if bonds_data is None:
+        raise PreventUpdate
+    bonds_data = to_history_frame(bonds_data)
+    return yield_surface_figure(
+        bonds_data, zoomed_range(relayout_data, 'bonds-hist')
     )
 
-    bonds_data.reset_index(drop=True, inplace=True)
 
-    return bonds_data.to_json(), fig, {'display': 'block'}
+def profile_table(profiler):
+    # Renders a StageProfiler's stage timings & counters as an html table.
+    stages = profiler.to_frame().round(3)
+    rows = [html.Tr([html.Th(col) for col in stages.columns])] + [
+        html.Tr([html.Td(str(value)) for value in row])
+        for row in stages.itertuples(index=False)
+    ] + [
+        html.Tr([html.Td(name), html.Td(str(value))])
+        for name, value in profiler.counters.items()
+    ]
+    return html.Table(rows)
+
+
+def proposed_trade_text(proposed, alpha, n):
+    # What to do at the next open, from the proposed trade's blotter rows.
+    if len(proposed) == 0:
+        return html.P('Proposed trade: none for the next trading day.')
+    buy = proposed[proposed['action'] == 'BUY'].iloc[0]
+    return html.P(
+        'Proposed trade: BUY ' + str(buy['size']) + ' ' + buy['symbol'] +
+        ' at market on the next open, then place a LIMIT SELL for ' +
+        str(buy['size']) + ' at ' + str(round(100 * alpha, 2)) +
+        '% above the fill price, good for ' + str(n) + ' trading days.'
+    )
+
+def backtest_job(job, ivv_hist, bonds_hist, n, N, alpha, lot_size,
+                 start_date, starting_cash):
+    # Runs in the background; returns the results' CACHE key and the
+    #   profiler that timed them.
+    profiler = StageProfiler() if PROFILE_BACKTEST else NULL_PROFILER
+    results = PIPELINE.run(
+        ivv_hist, bonds_hist, n, N, alpha, lot_size, start_date, starting_cash,
+        profiler=JobProgress(job, profiler)
+    )
+    if RESULTS_DIR:
+        write_results(results, new_run_dir(RESULTS_DIR), background=True)
+    return CACHE.put(results), profiler
 
 
 @app.callback(
-    [
-        dash.dependencies.Output('features-and-responses', 'data'),
-        dash.dependencies.Output('features-and-responses', 'columns'),
-        dash.dependencies.Output('blotter', 'data'),
-        dash.dependencies.Output('blotter', 'columns'),
-        dash.dependencies.Output('calendar-ledger', 'data'),
-        dash.dependencies.Output('calendar-ledger', 'columns'),
-        dash.dependencies.Output('trade-ledger', 'data'),
-        dash.dependencies.Output('trade-ledger', 'columns')
-    ],
+    dash.dependencies.Output('backtest-job', 'children'),
     [dash.dependencies.Input('ivv-hist', 'children'),
      dash.dependencies.Input('bonds-hist', 'children'),
      dash.dependencies.Input('lil-n', 'value'),
@@ -462,22 +563,70 @@ def update_bonds_hist(n_clicks, startDate, endDate, N, n):
      dash.dependencies.Input('lot-size', 'value'),
      dash.dependencies.Input('starting-cash', 'value'),
      dash.dependencies.State('hist-data-range', 'start_date'),
-     dash.dependencies.State('hist-data-range', 'end_date')],
+     dash.dependencies.State('backtest-job', 'children')],
     prevent_initial_call=True
 )
-def calculate_backtest(ivv_hist, bonds_hist, n, N, alpha, lot_size,
-                       starting_cash, start_date, end_date):
-    features_and_responses, blotter, calendar_ledger, trade_ledger = backtest(
-        ivv_hist, bonds_hist, n, N, alpha, lot_size, start_date, end_date,
+def start_backtest(ivv_hist, bonds_hist, n, N, alpha, lot_size,
+                   starting_cash, start_date, previous_job_id):
+    ivv_hist = CACHE.get(ivv_hist)
+    bonds_hist = CACHE.get(bonds_hist)
+    if ivv_hist is None or bonds_hist is None:
+        # Evicted, or from before a server restart: wait for a fresh run
+        raise PreventUpdate
+
+    # This page's earlier backtest is out of date now
+    JOBS.cancel(previous_job_id)
+    job = JOBS.submit(
+        backtest_job, ivv_hist, bonds_hist, n, N, alpha, lot_size, start_date,
         starting_cash
     )
+    return job.id
+
+
+@app.callback(
+    [
+        dash.dependencies.Output('features-and-responses', 'columns'),
+        dash.dependencies.Output('blotter', 'columns'),
+        dash.dependencies.Output('calendar-ledger', 'columns'),
+        dash.dependencies.Output('trade-ledger', 'columns'),
+        dash.dependencies.Output('backtest-profile', 'children'),
+        dash.dependencies.Output('proposed-trade', 'children'),
+        dash.dependencies.Output('backtest-run', 'children'),
+        dash.dependencies.Output('backtest-progress', 'children'),
+        dash.dependencies.Output('backtest-poll', 'disabled')
+    ],
+    [dash.dependencies.Input('backtest-poll', 'n_intervals'),
+     dash.dependencies.Input('backtest-job', 'children')],
+    [dash.dependencies.State('lil-n', 'value'),
+     dash.dependencies.State('alpha', 'value')],
+    prevent_initial_call=True
+)
+def calculate_backtest(n_intervals, job_id, n, alpha):
+    # Shows the backtest job's progress until it finishes, then its results.
+    #   Runs when a job is started too, to turn the poll on; the poll is
+    #   turned off again once the job is done.
+    job = JOBS.get(job_id)
+    if job is None:
+        return [dash.no_update] * 7 + ['', True]
+    if not job.finished:
+        return [dash.no_update] * 7 + [
+            'Backtest running: ' + job.progress, False
+        ]
+    if job.status != 'done':
+        return [dash.no_update] * 7 + ['Backtest ' + job.progress, True]
+
+    run_key, profiler = job.result
+    results = CACHE.get(run_key)
+    if results is None:
+        return [dash.no_update] * 7 + ['', True]
+    features_and_responses, blotter, calendar_ledger, trade_ledger = results
+
+    proposed = proposed_trade_text(proposed_trade(blotter), alpha, n)
 
     features_and_responses_columns = [
         {"name": i, "id": i} for i in features_and_responses.columns
     ]
-    features_and_responses = features_and_responses.to_dict('records')
 
-    blotter = blotter.to_dict('records')
     blotter_columns = [
         dict(id='ID', name='ID'),
         dict(id='ls', name='long/short'),
@@ -497,7 +646,6 @@ def calculate_backtest(ivv_hist, bonds_hist, n, N, alpha, lot_size,
         dict(id='filled_or_cancelled', name='Filled/Cancelled')
     ]
 
-    calendar_ledger = calendar_ledger.to_dict('records')
     calendar_ledger_columns = [
         dict(id='Date', name='Date'),
         dict(id='position', name='position'),
@@ -511,7 +659,6 @@ def calculate_backtest(ivv_hist, bonds_hist, n, N, alpha, lot_size,
              format=FormatTemplate.money(2))
     ]
 
-    trade_ledger = trade_ledger.to_dict('records')
     trade_ledger_columns = [
         dict(id='trade_id', name="ID"),
         dict(id='open_dt', name='Trade Opened'),
@@ -535,9 +682,44 @@ def calculate_backtest(ivv_hist, bonds_hist, n, N, alpha, lot_size,
              type='numeric', format=FormatTemplate.percentage(3))
     ]
 
-    return features_and_responses, features_and_responses_columns, blotter, \
-           blotter_columns, calendar_ledger, calendar_ledger_columns, \
-           trade_ledger, trade_ledger_columns
+    if PROFILE_BACKTEST:
+        profile = profile_table(profiler)
+    else:
+        profile = None
+
+    return features_and_responses_columns, blotter_columns, \
+           calendar_ledger_columns, trade_ledger_columns, profile, proposed, \
+           run_key, '', True
+
+
+def add_result_table_callback(table_id, result_index):
+    # Fills table_id with the page of the results[result_index] frame of the
+    #   current backtest run that the user is looking at.
+    @app.callback(
+        [dash.dependencies.Output(table_id, 'data'),
+         dash.dependencies.Output(table_id, 'page_count')],
+        [dash.dependencies.Input('backtest-run', 'children'),
+         dash.dependencies.Input(table_id, 'page_current'),
+         dash.dependencies.Input(table_id, 'page_size'),
+         dash.dependencies.Input(table_id, 'sort_by'),
+         dash.dependencies.Input(table_id, 'filter_query')],
+        prevent_initial_call=True
+    )
+    def update_result_table(run_key, page_current, page_size, sort_by,
+                            filter_query):
+        results = CACHE.get(run_key)
+        if results is None:
+            raise PreventUpdate
+        return query_frame(
+            results[result_index], filter_query, sort_by, page_current,
+            page_size
+        )
+
+
+for result_index, table_id in enumerate([
+    'features-and-responses', 'blotter', 'calendar-ledger', 'trade-ledger'
+]):
+    add_result_table_callback(table_id, result_index)
 
 
 @app.callback(
@@ -550,20 +732,21 @@ def calculate_backtest(ivv_hist, bonds_hist, n, N, alpha, lot_size,
         dash.dependencies.Output('strategy-vol', 'children'),
         dash.dependencies.Output('strategy-sharpe', 'children')
     ],
-    dash.dependencies.Input('trade-ledger', 'data'),
+    dash.dependencies.Input('backtest-run', 'children'),
     prevent_initial_call=True
 )
-def update_performance_metrics(trade_ledger):
-    trade_ledger = pd.DataFrame(trade_ledger)
+def update_performance_metrics(run_key):
+    results = CACHE.get(run_key)
+    if results is None:
+        raise PreventUpdate
+    trade_ledger = results[3]
+    metrics = performance_metrics(trade_ledger)
     trade_ledger = trade_ledger[1:]
 
-    X = trade_ledger['benchmark_rtn_per_trading_day'].values.reshape(-1, 1)
-
-    linreg_model = linear_model.LinearRegression()
-    linreg_model.fit(X, trade_ledger['trade_rtn_per_trading_day'])
+    X = trade_ledger['benchmark_rtn_per_trading_day'].values
 
     x_range = np.linspace(X.min(), X.max(), 100)
-    y_range = linreg_model.predict(x_range.reshape(-1, 1))
+    y_range = metrics['alpha'] + metrics['beta'] * x_range
 
     fig = px.scatter(
         trade_ledger,
@@ -574,27 +757,16 @@ def update_performance_metrics(trade_ledger):
 
     fig.add_traces(go.Scatter(x=x_range, y=y_range, name='OLS Fit'))
 
-    alpha = str(round(linreg_model.intercept_ * 100, 3)) + "% / trade"
-    beta = round(linreg_model.coef_[0], 3)
-
-    gmrr = (trade_ledger['trade_rtn_per_trading_day'] + 1).product() ** (
-            1 / len(
-        trade_ledger)) - 1
-
-    avg_trades_per_yr = round(
-        trade_ledger['open_dt'].groupby(
-            pd.DatetimeIndex(trade_ledger['open_dt']).year
-        ).agg('count').mean(),
-        0
-    )
+    alpha = str(round(metrics['alpha'] * 100, 3)) + "% / trade"
+    beta = round(metrics['beta'], 3)
 
-    vol = stdev(trade_ledger['trade_rtn_per_trading_day'])
+    avg_trades_per_yr = round(metrics['avg_trades_per_yr'], 0)
 
-    sharpe = round(gmrr / vol, 3)
+    sharpe = round(metrics['sharpe'], 3)
 
-    gmrr_str = str(round(gmrr, 3)) + "% / trade"
+    gmrr_str = str(round(metrics['gmrr'], 3)) + "% / trade"
 
-    vol_str = str(round(vol, 3)) + "% / trade"
+    vol_str = str(round(metrics['vol'], 3)) + "% / trade"
 
     return fig, alpha, beta, gmrr_str, avg_trades_per_yr, vol_str, sharpe
 
@@ -1,170 +1,330 @@
-from sklearn import linear_model
-from sklearn.metrics import r2_score
 import numpy as np
 import pandas as pd
-from math import log, isnan
+from math import isnan
 from statistics import stdev
-from numpy import repeat
-
-def trading_decision(
-        exit_date, response_var, features_and_responses, trading_date, N, n
-):
-    training_indices = features_and_responses[exit_date] < trading_date
-    training_X = features_and_responses[training_indices].tail(N)[
-        ['a', 'b', 'R2', 'ivv_vol']
-    ]
-    training_Y = features_and_responses[training_indices].tail(N)[response_var]
-
-    # Need at least two 1's to train a model
-    if sum(training_Y) < 2:
-        return 0
-
-    if sum(training_Y) < n:
-        logisticRegr = linear_model.LogisticRegression()
-        logisticRegr.fit(np.float64(training_X), np.float64(training_Y))
-        trade_decision = logisticRegr.predict(
-            np.float64(
-                features_and_responses[["a", "b", "R2", "ivv_vol"]][
-                    features_and_responses['Date'] == trading_date
-                    ]
-            )
-        ).item()
-    else:     # If EVERYTHING is a 1, then just go ahead and implement again.
-        trade_decision = 1
+from sklearn import linear_model
+from persistence import write_results
+from profiling import NULL_PROFILER
+
+# CMT maturities (in years) used to fit the yield curve features.
+BOND_FEATURE_COLUMNS = ["1 mo", "2 mo", "3 mo", "6 mo", "1 yr", "2 yr"]
+BOND_MATURITIES = np.array([1 / 12, 2 / 12, 3 / 12, 6 / 12, 1, 2])
+
+def fit_yield_curves(yields, maturities=BOND_MATURITIES):
+    # Least-squares fit of yield = a * maturity + b for every row of yields
+    #   (one row per date, one column per maturity), solved in closed form
+    #   for all dates at once. Returns the slope a, intercept b and R^2 of
+    #   each fitted line as arrays.
+    yields = np.asarray(yields, dtype=np.float64)
+    maturities = np.asarray(maturities, dtype=np.float64)
+
+    centered_maturities = maturities - maturities.mean()
+    mean_yields = yields.mean(axis=1)
+
+    a = (yields - mean_yields[:, None]) @ centered_maturities / \
+        (centered_maturities @ centered_maturities)
+    b = mean_yields - a * maturities.mean()
+
+    modeled_yields = b[:, None] + a[:, None] * maturities[None, :]
+    ss_res = ((yields - modeled_yields) ** 2).sum(axis=1)
+    ss_tot = ((yields - mean_yields[:, None]) ** 2).sum(axis=1)
+
+    # Same convention as sklearn's r2_score for a flat yield curve.
+    with np.errstate(divide='ignore', invalid='ignore'):
+        R2 = np.where(
+            ss_tot == 0, np.where(ss_res == 0, 1.0, 0.0), 1 - ss_res / ss_tot
+        )
 
-    return trade_decision
+    return a, b, R2
+
+def rolling_log_return_vol(close_prices, N):
+    # Volatility of day-over-day log returns observed over a window of N
+    #   closing prices, computed in one pass over the log-return array. Row i
+    #   of the result uses close_prices[i + 1 : i + N + 1], i.e. the N closes
+    #   ending on (and including) date i + N, so the result lines up with
+    #   close_prices[N:]. A 2-D close_prices (dates x symbols) gives one
+    #   column of vols per symbol.
+    close_prices = np.asarray(close_prices, dtype=np.float64)
+    log_returns = np.log(close_prices[:-1] / close_prices[1:])
+    windows = np.lib.stride_tricks.sliding_window_view(
+        log_returns, N - 1, axis=0
+    )
+    return windows[1:].std(axis=-1, ddof=1)
 
-def backtest(
-        ivv_hist, bonds_hist, n, N, alpha, lot_size, start_date, end_date,
-        starting_cash
+def response_arrays(
+        dates, open_prices, high_prices, low_prices, features_dates, n, alpha
 ):
-    # Convert JSON data to dataframes
-    ivv_hist = pd.read_json(ivv_hist)
-    bonds_hist = pd.read_json(bonds_hist)
-
-    # Create the features data frame from the bond yields & IVV hist data
-
-    # This function is what we'll apply to every row in bonds_hist.
-    def bonds_fun(yields_row):
-        maturities = pd.DataFrame([1 / 12, 2 / 12, 3 / 12, 6 / 12, 1, 2])
-        linreg_model = linear_model.LinearRegression()
-        linreg_model.fit(maturities, yields_row[1:])
-        modeled_bond_rates = linreg_model.predict(maturities)
-        return [yields_row["Date"].date(), linreg_model.coef_[0],
-                linreg_model.intercept_,
-                r2_score(yields_row[1:], modeled_bond_rates)]
-
-    # apply bonds_fun to every row in bonds_hist to make the features dataframe.
-    bonds_features = bonds_hist[
-        ["Date", "1 mo", "2 mo", "3 mo", "6 mo", "1 yr", "2 yr"]
-    ].apply(bonds_fun, axis=1, result_type='expand')
-    bonds_features.columns = ["Date", "a", "b", "R2"]
-    bonds_features['Date'] = pd.to_datetime(bonds_features['Date'])
-
-    # Get available volatility of day-over-day log returns based on closing
-    # prices for IVV using a window size of N days.
-    ivv_features = []
-
-    for dt in ivv_hist['Date'][N:]:
-        eod_close_prices = list(
-            ivv_hist['Close'][ivv_hist['Date'] <= dt].tail(N))
-        vol = stdev([
-            log(i / j) for i, j in zip(
-                eod_close_prices[:N - 1], eod_close_prices[1:]
-            )
-        ])
-        vol_row = [dt, vol]
-        ivv_features.append(vol_row)
-
-    ivv_features = pd.DataFrame(ivv_features)
-    ivv_features.columns = ["Date", "ivv_vol"]
-    ivv_features['Date'] = pd.to_datetime(ivv_features['Date'])
-
-    # here, I'm doing an inner merge on features from IVV and the bond rates,
-    # storing the result in a dataframe called 'features'.
-    # The reason is because federal and NYSE holidays are not exactly the same, so
-    # there are some days on which the federal government reports bond features
-    # but no IVV data exists, and vice versa.
-    features = pd.merge(bonds_features, ivv_features, on='Date')
-
-    # delete vars we no longer need
-    del bonds_hist
-    del bonds_features
-    del ivv_features
-
-    response = []
-
-    for features_dt in features['Date']:
-        # Get data for the next n days after response_date
-        ohlc_data = ivv_hist[['Date', 'Open', 'High', 'Low', 'Close']][
-            ivv_hist['Date'] > features_dt
-            ].head(n)
-
-        if len(ohlc_data) == 0:
-            response_row = repeat(None, 8).tolist()
-            response.append(response_row)
-            continue
-
-        less_than_n_ohlc_data_rows = len(ohlc_data) < n
-
-        entry_date = ohlc_data['Date'].head(1).item()
-        entry_price = ohlc_data['Open'].head(1).item()
-
-        target_price_long = entry_price * (1 + alpha)
-        target_price_short = entry_price * (1 - alpha)
-
-        high_price = max(ohlc_data['High'])
-        low_price = min(ohlc_data['Low'])
-
-        long_success = int(high_price >= target_price_long)
-        short_success = int(low_price <= target_price_short)
+    # Builds the RESPONSE data for every date in features_dates in one pass
+    #   over the OHLC arrays: the entry at the next trading day's open, and
+    #   whether/when a limit order at entry_price * (1 +/- alpha) would have
+    #   filled over the next n trading days. If a limit order never fills,
+    #   the exit is the last High/Low in the window. When fewer than n days
+    #   of data remain, an unfilled side is left blank (NaN/NaT) because its
+    #   outcome isn't known yet.
+    #
+    #   The price arrays are indexed by dates, either 1-D or 2-D (dates x
+    #   symbols, on a shared calendar). Returns a dict of arrays with one row
+    #   per features date (and one column per symbol if 2-D), including the
+    #   positions of the entry & exit days in dates.
+    open_prices = np.asarray(open_prices, dtype=np.float64)
+    high_prices = np.asarray(high_prices, dtype=np.float64)
+    low_prices = np.asarray(low_prices, dtype=np.float64)
+    n_rows = len(dates)
+    # Reshapes per-features-date values to broadcast against symbols
+    per_row = (-1,) + (1,) * (high_prices.ndim - 1)
+
+    # Index of the first trading day after each features date, and how many
+    # of the next n trading days are actually available.
+    start = np.searchsorted(
+        dates, np.asarray(features_dates, dtype=dates.dtype), side='right'
+    )
+    window_len = np.minimum(n, n_rows - start).reshape(per_row)
+    has_data = window_len > 0
+    full_window = window_len == n
+
+    # (len(features_dates) x n) windows of Highs and Lows; days past the end
+    # of the data are NaN, which never compare as a hit.
+    padding = np.full((n,) + high_prices.shape[1:], np.nan)
+    high_windows = np.lib.stride_tricks.sliding_window_view(
+        np.concatenate([high_prices, padding]), n, axis=0
+    )[start]
+    low_windows = np.lib.stride_tricks.sliding_window_view(
+        np.concatenate([low_prices, padding]), n, axis=0
+    )[start]
+
+    entry_idx = np.minimum(start, n_rows - 1)
+    entry_price = np.where(has_data, open_prices[entry_idx], np.nan)
+
+    target_price_long = entry_price * (1 + alpha)
+    target_price_short = entry_price * (1 - alpha)
+
+    long_hits = high_windows >= target_price_long[..., None]
+    short_hits = low_windows <= target_price_short[..., None]
+    long_success = long_hits.any(axis=-1)
+    short_success = short_hits.any(axis=-1)
+
+    # Exit on the first day the target is hit, otherwise on the last day of
+    # the window.
+    start = start.reshape(per_row)
+    last_day = np.maximum(window_len - 1, 0)
+    exit_idx_long = np.minimum(
+        start + np.where(long_success, long_hits.argmax(axis=-1), last_day),
+        n_rows - 1
+    )
+    exit_idx_short = np.minimum(
+        start + np.where(short_success, short_hits.argmax(axis=-1), last_day),
+        n_rows - 1
+    )
 
-        exit_long = next(
-            (y.values.tolist() for x, y in
-             ohlc_data[['Date', 'High']].iterrows()
-             if y[1] >= target_price_long),
-            ohlc_data[['Date', 'High']].tail(1).values.tolist()[0]
+    # Each side's own fields are blanked when its outcome isn't known. (The
+    # loop this replaced blanked exit_date_short with the long side and
+    # exit_price_long with the short side, which could book a FILLED long
+    # exit at a NaN price and turn cash into NaN.)
+    known_long = has_data & (long_success | full_window)
+    known_short = has_data & (short_success | full_window)
+
+    return {
+        'entry_idx': entry_idx,
+        'exit_idx_long': exit_idx_long,
+        'exit_idx_short': exit_idx_short,
+        'has_data': has_data.reshape(-1),
+        'known_long': known_long,
+        'known_short': known_short,
+        'entry_date': np.where(
+            has_data.reshape(-1), dates[entry_idx], np.datetime64('NaT')
+        ),
+        'entry_price': entry_price,
+        'long_success': np.where(known_long, long_success, np.nan),
+        'short_success': np.where(known_short, short_success, np.nan),
+        'exit_date_long': np.where(
+            known_long, dates[exit_idx_long], np.datetime64('NaT')
+        ),
+        'exit_price_long': np.where(
+            known_long, np.take_along_axis(high_prices, exit_idx_long, 0),
+            np.nan
+        ),
+        'exit_date_short': np.where(
+            known_short, dates[exit_idx_short], np.datetime64('NaT')
+        ),
+        'exit_price_short': np.where(
+            known_short, np.take_along_axis(low_prices, exit_idx_short, 0),
+            np.nan
         )
-
-        exit_short = next(
-            (y.values.tolist() for x, y in ohlc_data[['Date', 'Low']].iterrows()
-             if y[1] <= target_price_short),
-            ohlc_data[['Date', 'Low']].tail(1).values.tolist()[0]
+    }
+
+RESPONSE_COLUMNS = [
+    'entry_date', 'entry_price', 'long_success', 'short_success',
+    'exit_date_long', 'exit_price_long', 'exit_date_short', 'exit_price_short'
+]
+
+def label_responses(ivv_hist, features_dates, n, alpha):
+    # The RESPONSE data (see response_arrays) for the dates in features_dates,
+    #   as a dataframe.
+    response = response_arrays(
+        ivv_hist['Date'].values, ivv_hist['Open'].values,
+        ivv_hist['High'].values, ivv_hist['Low'].values, features_dates, n,
+        alpha
+    )
+    response = pd.DataFrame({col: response[col] for col in RESPONSE_COLUMNS})
+
+    return response.round(2)
+
+MODEL_FEATURE_COLUMNS = ['a', 'b', 'R2', 'ivv_vol']
+
+def fit_logistic_regressions(X, Y, weights, C=1.0, max_iter=100, tol=1e-10):
+    # Fits one L2-regularized logistic regression per leading index of X
+    #   (shape: models x rows x features), all at once, by batched Newton
+    #   steps. Rows with weight 0 are left out of a model's training set.
+    #   The objective is the same one sklearn's LogisticRegression() minimizes
+    #   by default (intercept not penalized), so the fitted models agree with
+    #   it. Returns (coefficients, intercepts).
+    n_models, n_rows, n_features = X.shape
+    design = np.concatenate([X, np.ones((n_models, n_rows, 1))], axis=2)
+    penalty = np.diag(np.append(np.repeat(1 / C, n_features), 0))
+
+    theta = np.zeros((n_models, n_features + 1))
+    for _ in range(max_iter):
+        p = 1 / (1 + np.exp(-np.einsum('mrf,mf->mr', design, theta)))
+        gradient = np.einsum('mrf,mr->mf', design, weights * (p - Y)) + \
+            theta @ penalty
+        hessian = np.einsum(
+            'mrf,mr,mrg->mfg', design, weights * p * (1 - p), design
+        ) + penalty
+        step = np.linalg.solve(hessian, gradient[..., None])[..., 0]
+        theta = theta - step
+        if np.abs(step).max() < tol:
+            break
+
+    return theta[:, :-1], theta[:, -1]
+
+def rolling_decision_arrays(
+        dates, exit_dates, responses, features, trading_positions, N, n,
+        chunk_size=256, profiler=NULL_PROFILER
+):
+    # Trade decisions for the rows at the positions in trading_positions.
+    #   For each trading date, a logistic regression is trained on the last N
+    #   rows whose exit date is before the trading date (i.e. whose outcome
+    #   was known), then used to predict the response for that date. Up to
+    #   chunk_size models are fit together.
+    #
+    #   exit_dates and responses are (rows x symbols) and features is (rows x
+    #   symbols x features), so a separate model is fit per symbol; returns a
+    #   (trading_positions x symbols) array of decisions.
+    #
+    #   A row's exit comes at most n trading days after its own date, so every
+    #   row more than n positions before a trading date has a known outcome.
+    #   The N training rows are therefore always found among the N + n rows
+    #   just before it, which lets each window be sliced by position.
+    trading_positions = np.asarray(trading_positions, dtype=np.int64)
+    n_symbols = responses.shape[1]
+
+    window = N + n
+    decisions = np.zeros((len(trading_positions), n_symbols), dtype=np.int64)
+    chunk_positions = max(1, chunk_size // n_symbols)
+
+    for chunk_start in range(0, len(trading_positions), chunk_positions):
+        positions = trading_positions[chunk_start:chunk_start + chunk_positions]
+
+        rows = positions[:, None] - window + np.arange(window)[None, :]
+        in_range = rows >= 0
+        rows = np.maximum(rows, 0)
+
+        known = in_range[:, :, None] & (
+            exit_dates[rows] < dates[positions][:, None, None]
         )
+        # keep only the last N known rows in each window
+        known_from_end = np.cumsum(known[:, ::-1], axis=1)[:, ::-1]
+        training = known & (known_from_end <= N)
+
+        training_Y = np.where(training, responses[rows], 0)
+        ones = training_Y.sum(axis=1)
+
+        # Need at least two 1's to train a model. If EVERYTHING is a 1 (or
+        # there are no 0's to learn from), then just go ahead and implement
+        # again.
+        chunk_decisions = np.where(ones < 2, 0, 1)
+        to_fit = (ones >= 2) & (ones < n) & (ones < training.sum(axis=1))
+
+        if to_fit.any():
+            profiler.count('model_fits', to_fit.sum())
+            coefficients, intercepts = fit_logistic_regressions(
+                np.moveaxis(features[rows], 2, 1)[to_fit],
+                np.moveaxis(training_Y, 2, 1)[to_fit],
+                np.moveaxis(training, 2, 1)[to_fit].astype(np.float64)
+            )
+            scores = np.einsum(
+                'mf,mf->m', features[positions][to_fit], coefficients
+            ) + intercepts
+            chunk_decisions[to_fit] = scores > 0
 
-        response_row = [entry_date, entry_price, long_success, short_success] + \
-                       exit_long + exit_short
-
-        if less_than_n_ohlc_data_rows:
-            if not bool(response_row[2]):
-                for i in [2, 4, 6]:
-                    response_row[i] = None
-            if not bool(response_row[3]):
-                for i in [3, 5, 7]:
-                    response_row[i] = None
+        decisions[chunk_start:chunk_start + len(positions)] = chunk_decisions
+        profiler.count('model_days', len(positions))
 
-        response.append(response_row)
+    return decisions
 
-    response = pd.DataFrame(response)
-    response.columns = ["entry_date", "entry_price", "long_success",
-                        "short_success", "exit_date_long", "exit_price_long",
-                        "exit_date_short", "exit_price_short"]
-    response = response.round(2)
+def rolling_trading_decisions(
+        exit_date, response_var, features_and_responses, trading_positions, N,
+        n, chunk_size=256, profiler=NULL_PROFILER
+):
+    # Trade decisions (see rolling_decision_arrays) for the rows of
+    #   features_and_responses at the positions in trading_positions, using
+    #   the exit_date and response_var columns.
+    return rolling_decision_arrays(
+        features_and_responses['Date'].values,
+        features_and_responses[[exit_date]].values,
+        features_and_responses[[response_var]].values.astype(np.float64),
+        features_and_responses[MODEL_FEATURE_COLUMNS].values.astype(
+            np.float64
+        )[:, None, :],
+        trading_positions, N, n, chunk_size, profiler
+    )[:, 0]
 
-    features_and_responses = pd.concat([features, response], axis=1)
-    del features
-    del response
+def trading_decision(
+        exit_date, response_var, features_and_responses, trading_date, N, n
+):
+    trading_position = np.flatnonzero(
+        features_and_responses['Date'] == trading_date
+    )
+    return rolling_trading_decisions(
+        exit_date, response_var, features_and_responses, trading_position, N,
+        n
+    )[0].item()
+
+def bond_features(bonds_hist):
+    # Fit a line through the yield curve on every date in bonds_hist at once
+    # to make the features dataframe. Dates missing any of the yields can't
+    # be fit, so they're left out.
+    bonds_hist = bonds_hist.dropna(subset=BOND_FEATURE_COLUMNS)
+    a, b, R2 = fit_yield_curves(bonds_hist[BOND_FEATURE_COLUMNS])
+    return pd.DataFrame({
+        'Date': pd.to_datetime(bonds_hist['Date']).dt.normalize(),
+        'a': a, 'b': b, 'R2': R2
+    })
+
+def vol_features(ivv_hist, N):
+    # Get available volatility of day-over-day log returns based on closing
+    # prices for IVV using a window size of N days.
+    ivv_features = pd.DataFrame({
+        'Date': ivv_hist['Date'][N:].values,
+        'ivv_vol': rolling_log_return_vol(ivv_hist['Close'], N)
+    })
+    ivv_features['Date'] = pd.to_datetime(ivv_features['Date'])
+    return ivv_features
 
+def build_blotter(
+        features_and_responses, trading_positions, trade_decisions_long, alpha,
+        lot_size, first_trade_id=0
+):
+    # Turns the trade decisions made on the rows of features_and_responses at
+    #   trading_positions into entry & exit orders. Trades are numbered from
+    #   first_trade_id.
     blotter = []
-    trade_id = 0
+    trade_id = first_trade_id
 
-    for trading_date in features_and_responses['Date'][
-        features_and_responses['Date'] >= pd.to_datetime(start_date)
-    ]:
-        trade_decision_long = trading_decision(
-            'exit_date_long', 'long_success', features_and_responses,
-            trading_date, N, n
-        )
+    for trading_position, trade_decision_long in zip(
+            trading_positions, trade_decisions_long
+    ):
+        trading_date = features_and_responses['Date'].iloc[trading_position]
         # trade_decision_short = trading_decision(
         #     'exit_date_short', 'short_success', features_and_responses,
         #     trading_date, N, n
@@ -176,11 +336,9 @@ def backtest(
         #     continue
 
         if trade_decision_long == 1:
-            right_answer = features_and_responses[
-                features_and_responses['Date'] == trading_date
-                ]
+            right_answer = features_and_responses.iloc[[trading_position]]
 
-            if trading_date == features_and_responses['Date'].tail(1).item():
+            if trading_position == len(features_and_responses) - 1:
                 order_status = 'PENDING'
                 submitted = order_price = fill_price = filled_or_cancelled = None
             else:
@@ -287,11 +445,10 @@ def backtest(
         #     blotter.append(exit_trade_lmt)
         #     trade_id += 1
 
-    blotter = pd.DataFrame(blotter)
-    blotter.columns = [
+    blotter = pd.DataFrame(blotter, columns=[
         'ID', 'ls', 'submitted', 'action', 'size', 'symbol', 'price', 'type',
         'status', 'fill_price', 'filled_or_cancelled'
-    ]
+    ])
     blotter = blotter.round(2)
     blotter.sort_values(
         by=['ID', 'submitted'],
@@ -300,116 +457,149 @@ def backtest(
     )
     blotter.reset_index()
 
-    calendar_ledger = []
-    cash = starting_cash
-    position = 0
-    stock_value = 0
-    total_value = cash
-
-    for ivv_row in ivv_hist[
-        ivv_hist['Date'] >= pd.to_datetime(start_date)
-    ].iterrows():
-        trading_date = ivv_row[1]['Date']
-        ivv_close = ivv_row[1]['Close']
-        trades = blotter[
-            (blotter['filled_or_cancelled'] == ivv_row[1]['Date']) & (
-                    blotter['status'] == 'FILLED'
-            )]
-        if len(trades) > 0:
-            position = position + sum(
-                trades['size'][trades['action'] == 'BUY']
-            ) - sum(
-                trades['size'][trades['action'] == 'SELL']
-            )
-            cash = cash - sum(
-                trades['size'][trades['action'] == 'BUY'] *
-                trades['fill_price'][
-                    trades['action'] == 'BUY'
-                    ]
-            ) + sum(
-                trades['size'][trades['action'] == 'SELL'] *
-                trades['fill_price'][
-                    trades['action'] == 'SELL'
-                    ]
-            )
-            stock_value = position * ivv_close
-            total_value = cash + stock_value
-        else:
-            stock_value = position * ivv_close
-            total_value = cash + stock_value
-
-        ledger_row = [
-            trading_date, position, ivv_close, cash, stock_value, total_value
-        ]
-        calendar_ledger.append(ledger_row)
-
-    calendar_ledger = pd.DataFrame(calendar_ledger)
-    calendar_ledger.columns = [
-        'Date', 'position', 'ivv_close', 'cash', 'stock_value', 'total_value'
-    ]
-
-    trade_ledger = []
-
-    for trade in blotter['ID'].unique():
-        round_trip_trade = blotter[
-            (blotter['ID'] == trade) & (blotter['status'] == 'FILLED')
-            ]
-
-        if len(round_trip_trade) < 2:
-            continue
-
-        trade_id = round_trip_trade['ID'].unique().item()
-
-        date_opened = min(round_trip_trade['submitted'])
-        date_closed = max(round_trip_trade['submitted'])
-
-        ivv_df = ivv_hist[(ivv_hist['Date'] <= date_closed) & (
-                    ivv_hist['Date'] >= date_opened
-            )]
-
-        trading_days_open = len(ivv_df)
+    return blotter
 
-        buy_price = round_trip_trade['fill_price'][
-            round_trip_trade['action'] == 'BUY'
-            ].item()
-        sell_price = round_trip_trade['fill_price'][
-            round_trip_trade['action'] == 'SELL'
-            ].item()
+def proposed_trade(blotter):
+    # The entry & exit orders to place before the next open: the trade whose
+    #   entry order is still PENDING. Empty if the model says not to trade.
+    pending_ids = blotter['ID'][blotter['status'] == 'PENDING']
+    return blotter[blotter['ID'].isin(pending_ids)]
 
-        ivv_price_enter = ivv_df['Close'][
-            ivv_df['Date'] == round_trip_trade['submitted'][
-                round_trip_trade['action'] == 'BUY'
-            ].item()
-        ].item()
-        ivv_price_exit = ivv_df['Close'][
-            ivv_df['Date'] == round_trip_trade['submitted'][
-                round_trip_trade['action'] == 'SELL'
-            ].item()
-        ].item()
-
-        trade_rtn = log(sell_price / buy_price)
-        ivv_rtn = log(ivv_price_exit / ivv_price_enter)
-
-        trade_rtn_per_trading_day = trade_rtn/trading_days_open
-        benchmark_rtn_per_trading_day   = ivv_rtn/trading_days_open
-
-        trade_ledger_row = [
-            trade_id, date_opened, date_closed, trading_days_open, buy_price,
-            sell_price, ivv_price_enter, ivv_price_exit, trade_rtn, ivv_rtn,
-            trade_rtn_per_trading_day, benchmark_rtn_per_trading_day
-        ]
-
-        trade_ledger.append(trade_ledger_row)
-
-    trade_ledger = pd.DataFrame(trade_ledger)
-    trade_ledger.columns = [
-        'trade_id', 'open_dt', 'close_dt', 'trading_days_open', 'buy_price',
-        'sell_price', 'benchmark_buy_price', 'benchmark_sell_price',
-        'trade_rtn', 'benchmark_rtn', 'trade_rtn_per_trading_day',
-        'benchmark_rtn_per_trading_day'
-    ]
+def calendar_ledger_arrays(
+        dates, close_prices, blotter, start_date, starting_cash,
+        starting_position=0
+):
+    # Position and cash on each trading day from start_date on are cumulative
+    #   sums of the FILLED trades' flows, so the fills are summed by fill
+    #   date once and lined up with the trading days in dates. Returns a dict
+    #   of arrays with one row per trading day.
+    on_calendar = dates >= np.datetime64(pd.to_datetime(start_date))
+    calendar_dates = dates[on_calendar]
+
+    fills = blotter[blotter['status'] == 'FILLED']
+    # Lot sizes may be fractional
+    size = pd.to_numeric(fills['size'])
+    notional = size * fills['fill_price'].astype(np.float64)
+    bought = fills['action'] == 'BUY'
+    sold = fills['action'] == 'SELL'
+    daily_flows = pd.DataFrame({
+        'Date': pd.to_datetime(fills['filled_or_cancelled']),
+        'position': size.where(bought, 0) - size.where(sold, 0),
+        'cash': notional.where(sold, 0) - notional.where(bought, 0)
+    }).groupby('Date').sum().reindex(calendar_dates, fill_value=0)
+
+    position = starting_position + daily_flows['position'].values.cumsum()
+    cash = starting_cash + daily_flows['cash'].values.cumsum()
+    ivv_close = np.asarray(close_prices)[on_calendar]
+    stock_value = position * ivv_close
+
+    return {
+        'Date': calendar_dates,
+        'position': position,
+        'ivv_close': ivv_close,
+        'cash': cash,
+        'stock_value': stock_value,
+        'total_value': cash + stock_value
+    }
+
+def build_calendar_ledger(
+        ivv_hist, blotter, start_date, starting_cash, starting_position=0
+):
+    # The calendar ledger (see calendar_ledger_arrays) over the IVV trading
+    #   days, as a dataframe.
+    return pd.DataFrame(calendar_ledger_arrays(
+        ivv_hist['Date'].values, ivv_hist['Close'].values, blotter,
+        start_date, starting_cash, starting_position
+    ))
+
+def trade_ledger_arrays(dates, close_prices, blotter):
+    # One row per round-trip trade, i.e. per trade ID with both a FILLED BUY
+    #   and a FILLED SELL leg. The legs are paired by ID; benchmark closes are
+    #   looked up by date and holding periods are counted in trading days.
+    #   Returns a dict of arrays.
+    fills = blotter[blotter['status'] == 'FILLED']
+    fills = fills[fills.groupby('ID')['ID'].transform('size') >= 2]
+
+    legs = ['ID', 'submitted', 'fill_price']
+    buys = fills[fills['action'] == 'BUY'][legs].set_index('ID')
+    sells = fills[fills['action'] == 'SELL'][legs].set_index('ID')
+    # Keep the trades in the order they appear in the blotter
+    round_trips = buys.join(sells, lsuffix='_buy', rsuffix='_sell').reindex(
+        pd.unique(fills['ID'])
+    )
 
-    # Final formatting
+    date_opened = round_trips[['submitted_buy', 'submitted_sell']].min(axis=1)
+    date_closed = round_trips[['submitted_buy', 'submitted_sell']].max(axis=1)
+
+    trading_days_open = np.searchsorted(
+        dates, date_closed.values, side='right'
+    ) - np.searchsorted(dates, date_opened.values, side='left')
+
+    ivv_close = pd.Series(close_prices, index=dates)
+    buy_price = round_trips['fill_price_buy'].values
+    sell_price = round_trips['fill_price_sell'].values
+    ivv_price_enter = ivv_close.reindex(round_trips['submitted_buy']).values
+    ivv_price_exit = ivv_close.reindex(round_trips['submitted_sell']).values
+
+    trade_rtn = np.log(sell_price / buy_price)
+    ivv_rtn = np.log(ivv_price_exit / ivv_price_enter)
+
+    return {
+        'trade_id': round_trips.index.values.astype(np.int64),
+        'open_dt': date_opened.values,
+        'close_dt': date_closed.values,
+        'trading_days_open': trading_days_open.astype(np.int64),
+        'buy_price': buy_price,
+        'sell_price': sell_price,
+        'benchmark_buy_price': ivv_price_enter,
+        'benchmark_sell_price': ivv_price_exit,
+        'trade_rtn': trade_rtn,
+        'benchmark_rtn': ivv_rtn,
+        'trade_rtn_per_trading_day': trade_rtn / trading_days_open,
+        'benchmark_rtn_per_trading_day': ivv_rtn / trading_days_open
+    }
+
+def build_trade_ledger(ivv_hist, blotter):
+    # The trade ledger (see trade_ledger_arrays) for blotter, as a dataframe.
+    return pd.DataFrame(trade_ledger_arrays(
+        ivv_hist['Date'].values, ivv_hist['Close'].values, blotter
+    ))
+
+def performance_metrics(trade_ledger):
+    # Summary statistics of a trade ledger against its benchmark, as shown in
+    #   the app: OLS alpha & beta of per-trading-day trade returns on
+    #   benchmark returns, geometric mean return, average trades per year,
+    #   volatility, and Sharpe ratio. The first (most recent) row of the
+    #   ledger is left out.
+    trade_ledger = trade_ledger[1:]
+
+    X = trade_ledger['benchmark_rtn_per_trading_day'].values.reshape(-1, 1)
+
+    linreg_model = linear_model.LinearRegression()
+    linreg_model.fit(X, trade_ledger['trade_rtn_per_trading_day'])
+
+    gmrr = (trade_ledger['trade_rtn_per_trading_day'] + 1).product() ** (
+            1 / len(trade_ledger)) - 1
+
+    avg_trades_per_yr = trade_ledger['open_dt'].groupby(
+        pd.DatetimeIndex(trade_ledger['open_dt']).year
+    ).agg('count').mean()
+
+    vol = stdev(trade_ledger['trade_rtn_per_trading_day'])
+
+    return {
+        'alpha': linreg_model.intercept_,
+        'beta': linreg_model.coef_[0],
+        'gmrr': gmrr,
+        'avg_trades_per_yr': avg_trades_per_yr,
+        'vol': vol,
+        'sharpe': gmrr / vol
+    }
+
+def format_results(
+        features_and_responses, blotter, calendar_ledger, trade_ledger
+):
+    # Turns the date columns of the results into plain dates, in place.
     features_and_responses['Date'] = features_and_responses['Date'].dt.date
     features_and_responses['entry_date'] = features_and_responses[
         'entry_date'].dt.date
@@ -427,9 +617,132 @@ def backtest(
     trade_ledger['open_dt'] = trade_ledger['open_dt'].dt.date
     trade_ledger['close_dt'] = trade_ledger['close_dt'].dt.date
 
-    features_and_responses.to_csv('features_and_responses.csv')
-    blotter.to_csv('blotter.csv')
-    calendar_ledger.to_csv('calendar_ledger.csv')
-    trade_ledger.to_csv('trade_ledger.csv')
+def to_history_frame(hist):
+    # Accepts a DataFrame, a dict of column arrays, or a NumPy structured
+    #   array of historical data, and returns it as a DataFrame sorted by a
+    #   datetime 'Date' column.
+    hist = pd.DataFrame(hist)
+    if not pd.api.types.is_datetime64_any_dtype(hist['Date']):
+        hist['Date'] = pd.to_datetime(hist['Date'])
+    if not hist['Date'].is_monotonic_increasing:
+        hist = hist.sort_values('Date')
+    return hist.reset_index(drop=True)
+
+def _stored(feature_store, key_parts, compute):
+    # compute()'s result, read from feature_store if it has it.
+    if feature_store is None:
+        return compute()
+    return feature_store.get_or_compute(
+        feature_store.key(*key_parts), compute
+    )
+
+def backtest(
+        ivv_hist, bonds_hist, n, N, alpha, lot_size, start_date, end_date,
+        starting_cash, output_dir=None, file_format='parquet', background=False,
+        profiler=NULL_PROFILER, feature_store=None
+):
+    # Convert JSON data to dataframes
+    with profiler.stage('json_decode'):
+        ivv_hist = pd.read_json(ivv_hist)
+        bonds_hist = pd.read_json(bonds_hist)
+
+    return run_backtest(
+        ivv_hist, bonds_hist, n, N, alpha, lot_size, start_date, end_date,
+        starting_cash, output_dir, file_format, background, profiler,
+        feature_store
+    )
+
+def run_backtest(
+        ivv_hist, bonds_hist, n, N, alpha, lot_size, start_date, end_date,
+        starting_cash, output_dir=None, file_format='parquet', background=False,
+        profiler=NULL_PROFILER, feature_store=None
+):
+    # Same as backtest(), but takes the IVV and bonds histories as
+    #   DataFrames (or anything to_history_frame accepts) instead of JSON, so
+    #   scripts & notebooks don't pay for serializing them.
+    #
+    #   The results are only saved if output_dir is given; see
+    #   persistence.write_results for file_format and background. Pass a
+    #   profiling.StageProfiler as profiler to record stage timings, and a
+    #   feature_store.FeatureStore as feature_store to reuse the features &
+    #   responses of earlier runs on the same data.
+    ivv_hist = to_history_frame(ivv_hist)
+    bonds_hist = to_history_frame(bonds_hist)
+
+    ivv_digest = bonds_digest = None
+    if feature_store is not None:
+        with profiler.stage(
+                'hash_inputs', rows=len(ivv_hist) + len(bonds_hist)
+        ):
+            ivv_digest = feature_store.digest(ivv_hist)
+            bonds_digest = feature_store.digest(bonds_hist)
+
+    # Create the features data frame from the bond yields & IVV hist data
+    with profiler.stage('bond_features', rows=len(bonds_hist)):
+        bonds_features = _stored(
+            feature_store, ('bond_features', bonds_digest),
+            lambda: bond_features(bonds_hist)
+        )
+    del bonds_hist
+
+    with profiler.stage('vol_features', rows=len(ivv_hist)):
+        ivv_features = _stored(
+            feature_store, ('vol_features', ivv_digest, N),
+            lambda: vol_features(ivv_hist, N)
+        )
+
+    # here, I'm doing an inner merge on features from IVV and the bond rates,
+    # storing the result in a dataframe called 'features'.
+    # The reason is because federal and NYSE holidays are not exactly the same, so
+    # there are some days on which the federal government reports bond features
+    # but no IVV data exists, and vice versa.
+    with profiler.stage('merge', rows=len(bonds_features) + len(ivv_features)):
+        features = pd.merge(bonds_features, ivv_features, on='Date')
+    del bonds_features
+    del ivv_features
+
+    with profiler.stage('responses', rows=len(features)):
+        response = _stored(
+            feature_store,
+            ('responses', ivv_digest, bonds_digest, N, n, alpha),
+            lambda: label_responses(ivv_hist, features['Date'], n, alpha)
+        )
+
+    features_and_responses = pd.concat([features, response], axis=1)
+    del features
+    del response
+
+    trading_positions = np.flatnonzero(
+        features_and_responses['Date'] >= pd.to_datetime(start_date)
+    )
+    with profiler.stage('model', rows=len(trading_positions)):
+        trade_decisions_long = rolling_trading_decisions(
+            'exit_date_long', 'long_success', features_and_responses,
+            trading_positions, N, n, profiler=profiler
+        )
+
+    with profiler.stage('blotter', rows=len(trading_positions)):
+        blotter = build_blotter(
+            features_and_responses, trading_positions, trade_decisions_long,
+            alpha, lot_size
+        )
+    with profiler.stage('calendar_ledger', rows=len(ivv_hist)):
+        calendar_ledger = build_calendar_ledger(
+            ivv_hist, blotter, start_date, starting_cash
+        )
+    with profiler.stage('trade_ledger', rows=len(blotter)):
+        trade_ledger = build_trade_ledger(ivv_hist, blotter)
+
+    # Final formatting
+    with profiler.stage('formatting'):
+        format_results(
+            features_and_responses, blotter, calendar_ledger, trade_ledger
+        )
+
+    results = features_and_responses, blotter, calendar_ledger, trade_ledger
+
+    if output_dir is not None:
+        with profiler.stage('write_results'):
+            write_results(results, output_dir, file_format, background)
 
-    return features_and_responses, blotter, calendar_ledger, trade_ledger
+    return results
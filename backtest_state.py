@@ -0,0 +1,277 @@
+# A backtest that can be brought up to date one day at a time.
+#
+# BacktestState holds everything backtest() computes, for one set of
+# parameters, and append() folds newly arrived IVV and CMT rate rows into it:
+# vol features and yield curve fits for the new dates only, new responses for
+# the rows whose n-day window wasn't complete before, model fits for the new
+# trading dates only, and the blotter & ledgers from the first trade that
+# could have changed. So adding a day costs about the same however long the
+# history is. States can be checkpointed to disk with save() and load().
+#
+# Rows must arrive in date order; anything dated on or before the last date
+# already held is ignored.
+
+import pickle
+import numpy as np
+import pandas as pd
+from backtest import bond_features, build_blotter, build_calendar_ledger, \
+    build_trade_ledger, format_results, label_responses, proposed_trade, \
+    rolling_log_return_vol, rolling_trading_decisions, to_history_frame
+
+class BacktestState:
+    def __init__(self, n, N, alpha, lot_size, start_date, starting_cash):
+        self.n = n
+        self.N = N
+        self.alpha = alpha
+        self.lot_size = lot_size
+        self.start_date = pd.to_datetime(start_date)
+        self.starting_cash = starting_cash
+
+        self.ivv_hist = pd.DataFrame(
+            columns=['Date', 'Open', 'High', 'Low', 'Close']
+        ).astype({'Date': 'datetime64[ns]'})
+        self.bonds_features = pd.DataFrame(
+            columns=['Date', 'a', 'b', 'R2']
+        ).astype({'Date': 'datetime64[ns]'})
+        self.ivv_features = pd.DataFrame(
+            columns=['Date', 'ivv_vol']
+        ).astype({'Date': 'datetime64[ns]'})
+        self.features_and_responses = None
+        self.trading_positions = np.zeros(0, dtype=np.int64)
+        self.trade_decisions_long = np.zeros(0, dtype=np.int64)
+        self.blotter = None
+        self.calendar_ledger = None
+        self.trade_ledger = None
+
+    @classmethod
+    def from_history(
+            cls, ivv_hist, bonds_hist, n, N, alpha, lot_size, start_date,
+            starting_cash
+    ):
+        state = cls(n, N, alpha, lot_size, start_date, starting_cash)
+        state.append(ivv_hist, bonds_hist)
+        return state
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def append(self, ivv_rows=None, bonds_rows=None):
+        # Adds new IVV OHLC rows and/or CMT rate rows (in any form
+        #   to_history_frame accepts) and updates everything that depends on
+        #   them.
+        old_ivv_rows = len(self.ivv_hist)
+        if self.features_and_responses is None:
+            old_features_rows = 0
+        else:
+            old_features_rows = len(self.features_and_responses)
+
+        if ivv_rows is not None:
+            self._append_ivv(to_history_frame(ivv_rows))
+        if bonds_rows is not None:
+            self._append_bonds(to_history_frame(bonds_rows))
+
+        relabel_from = self._update_features_and_responses(old_ivv_rows)
+        if len(self.features_and_responses) == old_features_rows and \
+                relabel_from == old_features_rows:
+            # No new trades, but the calendar ledger still runs through
+            # every IVV date (e.g. while the CMT rates lag behind).
+            if len(self.ivv_hist) > old_ivv_rows and \
+                    self.calendar_ledger is not None:
+                self._update_calendar_ledger(
+                    self.ivv_hist['Date'].iloc[old_ivv_rows - 1]
+                )
+            return self
+
+        self._update_decisions(old_features_rows)
+
+        # The first trade that may have changed: the first one whose
+        # response changed, or the one that used to be pending.
+        rebuild_from = min(relabel_from, max(old_features_rows - 1, 0))
+        self._update_blotter_and_ledgers(rebuild_from, old_ivv_rows)
+
+        return self
+
+    def results(self):
+        # Copies of the four frames backtest() returns, formatted the same.
+        results = (
+            self.features_and_responses.copy(), self.blotter.copy(),
+            self.calendar_ledger.copy(), self.trade_ledger.copy()
+        )
+        format_results(*results)
+        return results
+
+    def proposed_trade(self):
+        # The orders to place for the next trading day, if any.
+        return proposed_trade(self.blotter)
+
+    def _append_ivv(self, ivv_rows):
+        old = len(self.ivv_hist)
+        if old:
+            ivv_rows = ivv_rows[ivv_rows['Date'] > self.ivv_hist['Date'].iloc[-1]]
+        if len(ivv_rows) == 0:
+            return
+        self.ivv_hist = pd.concat(
+            [self.ivv_hist, ivv_rows[self.ivv_hist.columns]], ignore_index=True
+        )
+
+        # vol for the new dates only needs the N closes up to each of them
+        first_new = max(old, self.N)
+        if first_new < len(self.ivv_hist):
+            new_features = pd.DataFrame({
+                'Date': self.ivv_hist['Date'].values[first_new:],
+                'ivv_vol': rolling_log_return_vol(
+                    self.ivv_hist['Close'].values[first_new - self.N:], self.N
+                )
+            })
+            self.ivv_features = pd.concat(
+                [self.ivv_features, new_features], ignore_index=True
+            )
+
+    def _append_bonds(self, bonds_rows):
+        if len(self.bonds_features):
+            bonds_rows = bonds_rows[
+                bonds_rows['Date'] > self.bonds_features['Date'].iloc[-1]
+            ]
+        if len(bonds_rows) == 0:
+            return
+        self.bonds_features = pd.concat(
+            [self.bonds_features, bond_features(bonds_rows)], ignore_index=True
+        )
+
+    def _update_features_and_responses(self, old_ivv_rows):
+        # Adds the new features rows and relabels every row whose n-day
+        #   window wasn't complete before. Returns the first relabeled row.
+        far = self.features_and_responses
+        if far is None or len(far) == 0:
+            last_date = None
+            relabel_from = 0
+        else:
+            last_date = far['Date'].iloc[-1]
+            # Rows whose window of the next n trading days ran past the data
+            dates = self.ivv_hist['Date'].values
+            if old_ivv_rows > self.n:
+                relabel_from = np.searchsorted(
+                    far['Date'].values, dates[old_ivv_rows - self.n]
+                )
+            else:
+                relabel_from = 0
+
+        bonds_features, ivv_features = self.bonds_features, self.ivv_features
+        if last_date is not None:
+            bonds_features = bonds_features[bonds_features['Date'] > last_date]
+            ivv_features = ivv_features[ivv_features['Date'] > last_date]
+        new_features = pd.merge(bonds_features, ivv_features, on='Date')
+
+        if far is None:
+            features = new_features
+        else:
+            features = pd.concat([
+                far.iloc[relabel_from:][new_features.columns], new_features
+            ], ignore_index=True)
+        response = label_responses(
+            self.ivv_hist, features['Date'], self.n, self.alpha
+        )
+        relabeled = pd.concat([features, response], axis=1)
+
+        if far is None:
+            self.features_and_responses = relabeled
+        else:
+            self.features_and_responses = pd.concat(
+                [far.iloc[:relabel_from], relabeled], ignore_index=True
+            )
+        return relabel_from
+
+    def _update_decisions(self, old_features_rows):
+        # Past decisions only used responses known before their own trading
+        #   date, so only the new trading dates need a model.
+        far = self.features_and_responses
+        new_positions = old_features_rows + np.flatnonzero(
+            far['Date'].values[old_features_rows:] >=
+            self.start_date.to_datetime64()
+        )
+        new_decisions = rolling_trading_decisions(
+            'exit_date_long', 'long_success', far, new_positions, self.N,
+            self.n
+        )
+        self.trading_positions = np.append(
+            self.trading_positions, new_positions
+        )
+        self.trade_decisions_long = np.append(
+            self.trade_decisions_long, new_decisions
+        )
+
+    def _update_blotter_and_ledgers(self, rebuild_from, old_ivv_rows):
+        far = self.features_and_responses
+        ivv_hist = self.ivv_hist
+
+        # Trades are numbered in trading date order, so every trade from
+        # rebuild_from on has an ID of at least first_id.
+        decisions_from = np.searchsorted(self.trading_positions, rebuild_from)
+        first_id = np.count_nonzero(
+            self.trade_decisions_long[:decisions_from] == 1
+        )
+        new_blotter = build_blotter(
+            far, self.trading_positions[decisions_from:],
+            self.trade_decisions_long[decisions_from:], self.alpha,
+            self.lot_size, first_trade_id=first_id
+        )
+        new_trade_ledger = build_trade_ledger(ivv_hist, new_blotter)
+
+        if self.blotter is None:
+            self.blotter = new_blotter
+            self.trade_ledger = new_trade_ledger
+        else:
+            self.blotter = pd.concat([
+                new_blotter, self.blotter[self.blotter['ID'] < first_id]
+            ])
+            # A blotter of only a pending trade has no dates to infer from
+            for column in ['submitted', 'filled_or_cancelled']:
+                self.blotter[column] = pd.to_datetime(self.blotter[column])
+            self.trade_ledger = pd.concat([
+                new_trade_ledger,
+                self.trade_ledger[self.trade_ledger['trade_id'] < first_id]
+            ], ignore_index=True)
+
+        # Nothing changes in the calendar ledger before the day after the
+        # first rebuilt trading date or the first new IVV date, whichever is
+        # first.
+        if self.calendar_ledger is None or len(far) == 0:
+            self.calendar_ledger = build_calendar_ledger(
+                ivv_hist, self.blotter, self.start_date, self.starting_cash
+            )
+            return
+
+        cutoff = far['Date'].iloc[min(rebuild_from, len(far) - 1)]
+        if old_ivv_rows:
+            cutoff = min(cutoff, ivv_hist['Date'].iloc[old_ivv_rows - 1])
+        self._update_calendar_ledger(cutoff)
+
+    def _update_calendar_ledger(self, cutoff):
+        # Keeps the calendar ledger up to cutoff and rebuilds it from there.
+        ivv_hist = self.ivv_hist
+        kept = self.calendar_ledger[self.calendar_ledger['Date'] <= cutoff]
+        if len(kept):
+            cash = kept['cash'].iloc[-1]
+            position = kept['position'].iloc[-1]
+        else:
+            cash, position = self.starting_cash, 0
+
+        calendar_from = np.searchsorted(
+            ivv_hist['Date'].values, cutoff.to_datetime64(), side='right'
+        )
+        fills = self.blotter[
+            pd.to_datetime(self.blotter['filled_or_cancelled']) > cutoff
+        ]
+        self.calendar_ledger = pd.concat([
+            kept,
+            build_calendar_ledger(
+                ivv_hist.iloc[calendar_from:], fills, self.start_date, cash,
+                position
+            )
+        ], ignore_index=True)
@@ -0,0 +1,3 @@
+# Benchmarks for the backtest pipeline; see benchmarks/run.py.
+
+from benchmarks.synthetic import synthetic_cmt_rates, synthetic_ohlc
@@ -0,0 +1,85 @@
+# Checks that a BacktestState brought up to date one day at a time gives the
+# same results as a full backtest on the same data, e.g.
+#
+#   python -m benchmarks.check_state --bars 1500 --lag 25
+#
+# The CMT rates stop lag days before the IVV bars, so that the last days only
+# add IVV rows -- the calendar ledger still has to run through them.
+
+import sys
+from argparse import ArgumentParser
+
+import pandas as pd
+
+from backtest import run_backtest
+from backtest_state import BacktestState
+from benchmarks.synthetic import synthetic_cmt_rates, synthetic_ohlc
+
+# Frame name -> columns to sort it by before comparing
+RESULT_KEYS = [('features_and_responses', ['Date']),
+               ('blotter', ['ID', 'action']),
+               ('calendar_ledger', ['Date']),
+               ('trade_ledger', ['trade_id'])]
+
+def compare_incremental(
+        n_bars, n_appended, lag, n=5, N=10, alpha=0.02, lot_size=100,
+        starting_cash=50000, seed=0
+):
+    # Returns [(frame name, error or None)] comparing a full backtest with a
+    #   state built on all but the last n_appended IVV bars and then
+    #   appended to one day at a time. The CMT rates end lag bars before the
+    #   IVV bars.
+    ivv_hist = synthetic_ohlc(n_bars, seed=seed)
+    bonds_hist = synthetic_cmt_rates(n_bars - lag, seed=seed + 1)
+    start_date = ivv_hist['Date'].iloc[N + n]
+
+    full = run_backtest(
+        ivv_hist, bonds_hist, n, N, alpha, lot_size, start_date,
+        ivv_hist['Date'].iloc[-1], starting_cash
+    )
+
+    cut = ivv_hist['Date'].iloc[-n_appended - 1]
+    state = BacktestState.from_history(
+        ivv_hist[ivv_hist['Date'] <= cut], bonds_hist[bonds_hist['Date'] <= cut],
+        n, N, alpha, lot_size, start_date, starting_cash
+    )
+    for day in ivv_hist['Date'][ivv_hist['Date'] > cut]:
+        state.append(ivv_hist[ivv_hist['Date'] == day],
+                     bonds_hist[bonds_hist['Date'] == day])
+    incremental = state.results()
+
+    comparisons = []
+    for (name, key), a, b in zip(RESULT_KEYS, full, incremental):
+        a = a.sort_values(key).reset_index(drop=True)
+        b = b.sort_values(key).reset_index(drop=True)
+        try:
+            pd.testing.assert_frame_equal(a, b, check_dtype=False, rtol=1e-9)
+            comparisons.append((name, None))
+        except AssertionError as e:
+            comparisons.append((name, str(e)))
+    return comparisons
+
+def main():
+    parser = ArgumentParser(
+        description="Compare incremental and full backtests."
+    )
+    parser.add_argument('--bars', type=int, default=1500)
+    parser.add_argument('--appended', type=int, default=60,
+                        help="IVV bars appended one at a time")
+    parser.add_argument('--lag', type=int, default=25,
+                        help="IVV bars after the last CMT rates")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    ok = True
+    for name, error in compare_incremental(
+            args.bars, args.appended, args.lag, seed=args.seed
+    ):
+        print(name.ljust(24) + ('same' if error is None else 'DIFFERENT'))
+        if error is not None:
+            print(error)
+            ok = False
+    sys.exit(0 if ok else 1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+# Times each stage of the backtest on synthetic histories of increasing size
+# and writes the timings as JSON, e.g.
+#
+#   python -m benchmarks.run --sizes 1000 10000 100000 --out bench.json
+#
+# Compare the JSON from two commits to catch performance regressions.
+
+import json
+import platform
+from argparse import ArgumentParser
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import sklearn
+
+from backtest import run_backtest
+from benchmarks.synthetic import synthetic_cmt_rates, synthetic_dates, \
+    synthetic_ohlc
+from profiling import StageProfiler
+
+# A million daily bars only fit in pandas >= 2's datetime range
+DEFAULT_SIZES = [1000, 10000, 100000] + \
+    ([1000000] if int(pd.__version__.split('.')[0]) >= 2 else [])
+
+def time_stages(
+        ivv_hist, bonds_hist, n, N, alpha, lot_size, starting_cash,
+        start_date=None
+):
+    # Runs the backtest on the given histories and returns
+    #   {stage: seconds}. By default, trades from the (N + n)th bar on.
+    if start_date is None:
+        start_date = ivv_hist['Date'].iloc[min(N + n, len(ivv_hist) - 1)]
+
+    profiler = StageProfiler(trace_memory=False)
+    run_backtest(
+        ivv_hist, bonds_hist, n, N, alpha, lot_size, start_date,
+        ivv_hist['Date'].iloc[-1], starting_cash, profiler=profiler
+    )
+
+    timings = {s['stage']: s['wall_s'] for s in profiler.stages}
+    timings['total'] = sum(timings.values())
+    return timings
+
+def run_benchmarks(
+        sizes, n=5, N=10, alpha=0.02, lot_size=100, starting_cash=50000,
+        seed=0, repeat=1, out=None
+):
+    # Returns a JSON-ready dict of per-stage timings (the best of `repeat`
+    #   runs) for each history size, plus the environment they ran in. If
+    #   out is given, the results so far are written there after each size.
+    # Fail now rather than after the smaller sizes
+    synthetic_dates(max(sizes))
+
+    results = []
+    report = {
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'numpy': np.__version__,
+            'pandas': pd.__version__,
+            'sklearn': sklearn.__version__
+        },
+        'parameters': {
+            'n': n, 'N': N, 'alpha': alpha, 'lot_size': lot_size,
+            'starting_cash': starting_cash, 'seed': seed, 'repeat': repeat
+        },
+        'results': results
+    }
+
+    for size in sizes:
+        ivv_hist = synthetic_ohlc(size, seed=seed)
+        bonds_hist = synthetic_cmt_rates(size, seed=seed + 1)
+
+        runs = [
+            time_stages(ivv_hist, bonds_hist, n, N, alpha, lot_size,
+                        starting_cash)
+            for _ in range(repeat)
+        ]
+        for stage in runs[0]:
+            results.append({
+                'n_bars': size,
+                'stage': stage,
+                'seconds': min(run[stage] for run in runs)
+            })
+            print(str(size).rjust(8) + ' bars  ' + stage.ljust(16) +
+                  '%.4f s' % results[-1]['seconds'])
+
+        if out is not None:
+            with open(out, 'w') as f:
+                json.dump(report, f, indent=2)
+
+    return report
+
+def main():
+    parser = ArgumentParser(description="Benchmark the backtest stages.")
+    parser.add_argument(
+        '--sizes', type=int, nargs='+', default=DEFAULT_SIZES,
+        help="numbers of bars to benchmark (default: %(default)s)"
+    )
+    parser.add_argument('--n', type=int, default=5)
+    parser.add_argument('--N', type=int, default=10)
+    parser.add_argument('--alpha', type=float, default=0.02)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=1,
+                        help="runs per size; the fastest is kept")
+    parser.add_argument('--out', default='bench_output.json',
+                        help="where to write the JSON (default: %(default)s)")
+    args = parser.parse_args()
+
+    run_benchmarks(args.sizes, n=args.n, N=args.N, alpha=args.alpha,
+                   seed=args.seed, repeat=args.repeat, out=args.out)
+    print("wrote " + args.out)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+# Seeded synthetic market data for benchmarking: OHLC + VWAP bars shaped like
+# the files in bbg_data, and US Treasury CMT rates shaped like the tables
+# returned by utils.fetch_usdt_rates.
+#
+# Bars are one per calendar day from start_date. Histories longer than pandas'
+# nanosecond datetime range (about 213k days from 1678) need pandas >= 2, where
+# the dates are kept at second resolution instead.
+
+import numpy as np
+import pandas as pd
+from scipy.signal import lfilter
+
+CMT_COLUMNS = [
+    "1 mo", "2 mo", "3 mo", "6 mo", "1 yr", "2 yr", "3 yr", "5 yr", "7 yr",
+    "10 yr", "20 yr", "30 yr"
+]
+CMT_MATURITIES = np.array([1 / 12, 2 / 12, 3 / 12, 6 / 12, 1, 2, 3, 5, 7, 10,
+                           20, 30])
+
+def synthetic_dates(n_bars, start_date='1700-01-01'):
+    dates = np.datetime64(start_date, 'D') + np.arange(n_bars)
+    try:
+        return pd.Series(pd.DatetimeIndex(dates.astype('datetime64[s]')))
+    except (pd.errors.OutOfBoundsDatetime, ValueError):
+        raise ValueError(
+            str(n_bars) + " daily bars from " + start_date + " don't fit in " +
+            "this version of pandas' datetime range; use fewer bars or a " +
+            "later start_date"
+        )
+
+def synthetic_ohlc(
+        n_bars, seed=0, start_date='1700-01-01', start_price=100.0,
+        daily_vol=0.012
+):
+    # Geometric random walk of closing prices, with each day's open gapping
+    #   from the previous close and highs/lows extending past both.
+    rng = np.random.default_rng(seed)
+
+    log_returns = rng.normal(0, daily_vol, n_bars)
+    close = start_price * np.exp(np.cumsum(log_returns))
+    prev_close = np.append(start_price, close[:-1])
+    open_ = prev_close * np.exp(rng.normal(0, daily_vol / 4, n_bars))
+    high = np.maximum(open_, close) * np.exp(
+        np.abs(rng.normal(0, daily_vol / 2, n_bars))
+    )
+    low = np.minimum(open_, close) * np.exp(
+        -np.abs(rng.normal(0, daily_vol / 2, n_bars))
+    )
+    vwap = (high + low + close) / 3
+
+    return pd.DataFrame({
+        'Date': synthetic_dates(n_bars, start_date),
+        'Open': open_.round(2),
+        'High': high.round(2),
+        'Low': low.round(2),
+        'Close': close.round(2),
+        'VWAP': vwap
+    })
+
+def synthetic_cmt_rates(n_days, seed=0, start_date='1700-01-01'):
+    # Yield curves whose level, slope and curvature follow mean-reverting
+    #   random walks (a Nelson-Siegel curve), plus a little noise per
+    #   maturity. Rates are in percent, rounded to the hundredth like the
+    #   Treasury's.
+    rng = np.random.default_rng(seed)
+
+    def ar1(mean, phi, sd):
+        return mean + lfilter([1], [1, -phi], rng.normal(0, sd, n_days))
+
+    level = ar1(3.0, 0.999, 0.03)
+    slope = ar1(-1.5, 0.999, 0.03)
+    curvature = ar1(0.5, 0.995, 0.05)
+
+    decay = CMT_MATURITIES / 1.5
+    slope_loading = (1 - np.exp(-decay)) / decay
+    curvature_loading = slope_loading - np.exp(-decay)
+
+    rates = level[:, None] + slope[:, None] * slope_loading[None, :] + \
+        curvature[:, None] * curvature_loading[None, :] + \
+        rng.normal(0, 0.01, (n_days, len(CMT_MATURITIES)))
+    rates = np.maximum(rates, 0).round(2)
+
+    cmt_rates = pd.DataFrame(rates, columns=CMT_COLUMNS)
+    cmt_rates.insert(0, 'Date', synthetic_dates(n_days, start_date))
+    return cmt_rates
@@ -10,12 +10,44 @@ from optparse import OptionParser
 import os
 import platform as plat
 import sys
-with os.add_dll_directory('C:\\blp\\BloombergWindowsSDK\\C++API\\v3.16.1.1\\lib'):
-    import blpapi
-
+# Set BLOOMBERG_API to 'fake' to get made-up bars from fake_refdata instead of
+# a Bloomberg connection.
+if os.environ.get('BLOOMBERG_API') == 'fake':
+    import fake_refdata as blpapi
+else:
+    with os.add_dll_directory('C:\\blp\\BloombergWindowsSDK\\C++API\\v3.16.1.1\\lib'):
+        import blpapi
+
+from bloomberg_session import BloombergError, BloombergSession
+from datetime import date, timedelta
+from market_data_store import MarketDataStore
 from utils import date_to_str
+import numpy as np
 import pandas as pd
 
+# Historical data already downloaded, kept in bbg_data
+MARKET_DATA = MarketDataStore()
+
+# Most daily bars Bloomberg returns per security per request
+MAX_DATA_POINTS = 1400 # Don't adjust please :)
+
+# Most securities and fields per HistoricalDataRequest
+MAX_SECURITIES = 100
+MAX_FIELDS = 25
+
+# The fields MARKET_DATA keeps, and the columns they're kept as
+HISTORY_FIELDS = ["OPEN", "HIGH", "LOW", "PX_LAST", "EQY_WEIGHTED_AVG_PX"]
+FIELD_COLUMNS = dict(zip(HISTORY_FIELDS,
+                         ["Open", "High", "Low", "Close", "VWAP"]))
+
+# One session, kept open for every request. Set BLOOMBERG_HOST and
+# BLOOMBERG_PORT to connect somewhere other than the local terminal.
+BLOOMBERG = BloombergSession(
+    blpapi,
+    host=os.environ.get('BLOOMBERG_HOST', 'localhost'),
+    port=int(os.environ.get('BLOOMBERG_PORT', 8194))
+)
+
 def parseCmdLine():
     parser = OptionParser(description="Retrieve reference data.")
     parser.add_option("-a",
@@ -35,6 +67,148 @@ def parseCmdLine():
 
     return options
 
+def weekday_chunks(first, last, max_points=MAX_DATA_POINTS):
+    # Splits the dates first to last into consecutive (first, last) pieces
+    #   with at most max_points weekdays each -- so at most max_points daily
+    #   bars each. Pieces with no weekdays are left out.
+    chunks = []
+    first = np.busday_offset(np.datetime64(first, 'D'), 0, roll='forward')
+    last = np.datetime64(last, 'D')
+    while first <= last:
+        chunk_last = min(np.busday_offset(first, max_points - 1), last)
+        chunks.append((first.astype(object), chunk_last.astype(object)))
+        first = np.busday_offset(chunk_last + 1, 0, roll='forward')
+    return chunks
+
+def batches(items, size):
+    # items in consecutive lists of at most size.
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+def parse_history(msg):
+    # (security, DataFrame of its daily values, error) from a response
+    #   message: the values have a 'Date' column and one column per field
+    #   that came back; error is None unless Bloomberg couldn't find the
+    #   security.
+    securityData = msg.getElement("securityData")
+    security = securityData.getElementAsString("security")
+    if securityData.hasElement("securityError"):
+        return security, None, str(securityData.getElement("securityError"))
+
+    histdata = []
+    for fd in securityData.getElement("fieldData").values():
+        histdata.append({str(field.name()): field.getValue()
+                         for field in fd.elements()})
+    histdata = pd.DataFrame(histdata) if histdata else \
+        pd.DataFrame(columns=["date"])
+    histdata = histdata.rename(columns={"date": "Date"})
+    histdata["Date"] = pd.to_datetime(histdata["Date"])
+    return security, histdata, None
+
+def store_history(result):
+    # Writes a parse_history result's bars to MARKET_DATA.
+    security, histdata, error = result
+    if error is None:
+        # New bars are appended to what's stored; older ones are merged in.
+        MARKET_DATA.write(security, histdata.rename(columns=FIELD_COLUMNS))
+
+def fetch_history(bbg_identifiers, first, last, fields=HISTORY_FIELDS):
+    # Requests the daily values of fields from first to last (dates) for
+    #   every one of bbg_identifiers, in as few requests as Bloomberg
+    #   takes: up to MAX_SECURITIES securities and MAX_FIELDS fields each,
+    #   over at most MAX_DATA_POINTS weekdays. Returns ({security: DataFrame
+    #   of its values}, {security: error} for any Bloomberg couldn't find);
+    #   the HISTORY_FIELDS columns are named as in MARKET_DATA. If fields
+    #   has all of HISTORY_FIELDS, each security's bars are also written to
+    #   MARKET_DATA as soon as its part of a response comes in.
+    first, last = pd.to_datetime(first).date(), pd.to_datetime(last).date()
+    securities = list(dict.fromkeys(bbg_identifiers))
+    # HISTORY_FIELDS first, so that they're requested together
+    fields = sorted(dict.fromkeys(fields),
+                    key=lambda field: field not in FIELD_COLUMNS)
+
+    # security -> [DataFrame of its values for each batch of fields]
+    history = {security: [] for security in securities}
+    errors = {}
+    for field_batch in batches(fields, MAX_FIELDS):
+        on_result = store_history \
+            if set(FIELD_COLUMNS) <= set(field_batch) else None
+        # security -> [DataFrame of its values in each date chunk]
+        chunks = {security: [] for security in securities}
+        for chunk_first, chunk_last in weekday_chunks(first, last):
+            for security_batch in batches(securities, MAX_SECURITIES):
+                responses = BLOOMBERG.request("HistoricalDataRequest", {
+                    "securities": security_batch,
+                    "fields": field_batch,
+                    "periodicityAdjustment": "ACTUAL",
+                    "periodicitySelection": "DAILY",
+                    "startDate": date_to_str(chunk_first, "%Y%m%d"),
+                    "endDate": date_to_str(chunk_last, "%Y%m%d"),
+                    "maxDataPoints": MAX_DATA_POINTS
+                }, parse_history, on_result)
+
+                for security, histdata, error in responses:
+                    if error is not None:
+                        errors[security] = error
+                    else:
+                        chunks[security].append(histdata)
+
+        for security, frames in chunks.items():
+            if frames:
+                histdata = pd.concat(frames, ignore_index=True)
+            else:
+                histdata = pd.DataFrame({"Date": pd.to_datetime([])})
+            # Fields that never came back are left empty
+            history[security].append(
+                histdata.set_index("Date").reindex(columns=field_batch)
+            )
+
+    history = {
+        security: pd.concat(frames, axis=1).sort_index().reset_index() \
+            .rename(columns=FIELD_COLUMNS)
+        for security, frames in history.items() if security not in errors
+    }
+    return history, errors
+
+def req_historical_data_batch(bbg_identifiers, startDate, endDate):
+    # {ticker: DataFrame of its bars from startDate to endDate} for each of
+    #   bbg_identifiers (None for any that Bloomberg doesn't know and that
+    #   isn't stored). Whatever MARKET_DATA is missing is fetched first;
+    #   tickers missing the same dates are fetched together.
+    first_new = pd.to_datetime(startDate).date()
+    last_new  = pd.to_datetime(endDate).date()
+
+    # First, check which parts of the date range the local market data store
+    # doesn't have yet for each ticker. Only those are requested.
+    missing = {}
+    for bbg_identifier in dict.fromkeys(bbg_identifiers):
+        for segment in MARKET_DATA.missing(bbg_identifier, first_new,
+                                           last_new):
+            missing.setdefault(segment, []).append(bbg_identifier)
+
+    try:
+        for (segment_first, segment_last), tickers in missing.items():
+            history, errors = fetch_history(tickers, segment_first,
+                                            segment_last)
+            for bbg_identifier, error in errors.items():
+                print("Couldn't fetch " + bbg_identifier + \
+                      " from Bloomberg: " + error)
+
+            # Today's bar isn't final until tomorrow, so it stays missing
+            covered_last = min(segment_last, date.today() - timedelta(days=1))
+            if covered_last >= segment_first:
+                for bbg_identifier in history:
+                    MARKET_DATA.add_coverage(
+                        bbg_identifier, segment_first, covered_last
+                    )
+    except BloombergError as e:
+        print("Couldn't fetch from Bloomberg (" + repr(e) + \
+              "); using the local copy.")
+
+    return {
+        bbg_identifier: MARKET_DATA.read(bbg_identifier, first_new, last_new)
+        for bbg_identifier in bbg_identifiers
+    }
+
 def req_historical_data(bbg_identifier, startDate, endDate):
 
 
@@ -48,130 +222,9 @@ def req_historical_data(bbg_identifier, startDate, endDate):
             "specified startDate is later than endDate!"
         )
 
-    # First, check to see if there is already a local .p data file with the
-    # data you need for bbg_identifier. If it's not there, create it.
-    if not os.path.isdir("bbg_data"):
-        os.makedirs("bbg_data")
-        print("created the 'bbg_data' folder.")
-
-    if (bbg_identifier + ".csv") in os.listdir("bbg_data"):
-        old_bbg_data = pd.read_csv("bbg_data/" + bbg_identifier + ".csv")
-
-        first_old = pd.to_datetime(min(old_bbg_data['Date'])).date()
-        last_old  = pd.to_datetime(max(old_bbg_data['Date'])).date()
-
-        first_new = pd.to_datetime(startDate).date()
-        last_new  = pd.to_datetime(endDate).date()
-
-        if first_old <= first_new and last_old >= last_new:
-            # Don't need to make a query; have all data we need.
-            histdata = old_bbg_data[[
-                (pd.to_datetime(x).date() <= last_new) & (
-                        pd.to_datetime(x).date() >= first_new
-                ) for x in old_bbg_data['Date']
-            ]]
-            histdata.reset_index(drop=True, inplace=True)
-            return histdata
-
-        if first_old > first_new and last_old < last_new:
-            # do nothing for now, just requery the bigger dataset. Can refine
-            # this case later.
-            print(
-                "overwriting old data with date range: " + startDate + \
-                " to " + endDate
-            )
-        else:
-            if first_new < first_old:
-                endDate = date_to_str(first_old, "%Y%m%d")
-            else:
-                startDate = date_to_str(last_old, "%Y%m%d")
-
-    print(startDate)
-
-    options = parseCmdLine()
-
-    # Fill SessionOptions
-    sessionOptions = blpapi.SessionOptions()
-    sessionOptions.setServerHost(options.host)
-    sessionOptions.setServerPort(options.port)
-
-    print("Connecting to %s:%s" % (options.host, options.port))
-    # Create a Session
-    session = blpapi.Session(sessionOptions)
-
-    # Start a Session
-    if not session.start():
-        print("Failed to start session.")
-        return
-
-    try:
-        # Open service to get historical data from
-        if not session.openService("//blp/refdata"):
-            print("Failed to open //blp/refdata")
-            return
-
-        # Obtain previously opened service
-        refDataService = session.getService("//blp/refdata")
-
-        # Create and fill the request for the historical data
-        request = refDataService.createRequest("HistoricalDataRequest")
-        request.getElement("securities").appendValue(bbg_identifier)
-        request.getElement("fields").appendValue("OPEN")
-        request.getElement("fields").appendValue("HIGH")
-        request.getElement("fields").appendValue("LOW")
-        request.getElement("fields").appendValue("PX_LAST")
-        request.getElement("fields").appendValue("EQY_WEIGHTED_AVG_PX")
-        request.set("periodicityAdjustment", "ACTUAL")
-        request.set("periodicitySelection", "DAILY")
-        request.set("startDate", startDate)
-        request.set("endDate", endDate)
-        request.set("maxDataPoints", 1400) # Don't adjust please :)
-
-        print("Sending Request:", request)
-        # Send the request
-        session.sendRequest(request)
-
-        # Process received events
-        while (True):
-            # We provide timeout to give the chance for Ctrl+C handling:
-            ev = session.nextEvent(500)
-            for msg in ev:
-                if str(msg.messageType()) == "HistoricalDataResponse":
-
-                    histdata = []
-
-                    for fd in msg.getElement("securityData").getElement(
-                            "fieldData").values():
-                        histdata.append([fd.getElementAsString("date"), \
-                                         fd.getElementAsFloat("OPEN"),
-                                         fd.getElementAsFloat(
-                                             "HIGH"),
-                                         fd.getElementAsFloat("LOW"), \
-                                         fd.getElementAsFloat("PX_LAST"), \
-                                         fd.getElementAsFloat(
-                                             "EQY_WEIGHTED_AVG_PX")])
-
-                    histdata = pd.DataFrame(histdata, columns=["Date",
-                                                               "Open",
-                                                               "High", "Low",
-                                                               "Close", "VWAP"])
-
-            if ev.eventType() == blpapi.Event.RESPONSE:
-                # Response completely received, so we could exit
-                if 'old_bbg_data' in locals():
-                    histdata = pd.concat([histdata, old_bbg_data], axis=0)
-                    histdata = histdata.drop_duplicates('Date')
-                    histdata = histdata.sort_values('Date')
-                    histdata.reset_index(drop=True, inplace=True)
-
-                pd.DataFrame.to_csv(
-                    histdata, "bbg_data/" + bbg_identifier + ".csv", index=False
-                )
-
-                return histdata
-    finally:
-        # Stop the session
-        session.stop()
+    return req_historical_data_batch(
+        [bbg_identifier], startDate, endDate
+    )[bbg_identifier]
 
 __copyright__ = """
 Copyright 2012. Bloomberg Finance L.P.
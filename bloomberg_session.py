@@ -0,0 +1,248 @@
+# A long-lived session to Bloomberg's //blp/refdata service.
+#
+# Starting a blpapi session and opening a service takes a while, so
+# BloombergSession starts one the first time it's needed and keeps it (and
+# the service handle) for every request after that. Requests from any
+# thread share it: each is sent with its own correlation ID, and blpapi's
+# event thread hands each response message to the request it answers. If
+# the session goes down (or a request gets no answer within timeout), the
+# next request starts a new one, and requests that were waiting on the old
+# one are resent on it.
+#
+# request() also coalesces identical requests: while one is waiting on
+# Bloomberg, the same request from another thread (e.g. another user of the
+# app loading the same ticker) waits for that response instead of sending
+# its own.
+#
+# api is the module the session classes come from: blpapi, or fake_refdata
+# to run without a Bloomberg connection.
+
+import itertools
+import threading
+from concurrent.futures import Future
+
+class BloombergError(Exception):
+    pass
+
+class SessionLost(BloombergError):
+    # The session went down before the request was answered.
+    pass
+
+class _Pending:
+    # A request sent on the session, waiting for the rest of its response.
+    def __init__(self, on_message, generation):
+        self.on_message = on_message
+        self.generation = generation
+        self.error = None
+        self.done = threading.Event()
+
+    def fail(self, error):
+        if self.error is None:
+            self.error = error
+        self.done.set()
+
+class BloombergSession:
+    def __init__(self, api, host='localhost', port=8194,
+                 service='//blp/refdata', timeout=120, retries=1):
+        self.api = api
+        self.host = host
+        self.port = port
+        self.service_name = service
+        self.timeout = timeout
+        self.retries = retries
+        self._session = None
+        self._service = None
+        # Which session _session is; events from older ones are ignored
+        self._generation = None
+        self._generations = itertools.count(1)
+        self._request_ids = itertools.count(1)
+        # correlation ID -> _Pending
+        self._pending = {}
+        # request key -> Future of its result, for requests being sent
+        self._in_flight = {}
+        self._start_lock = threading.Lock()
+        self._lock = threading.Lock()
+
+    def service(self):
+        # (service handle, session generation), starting a session first if
+        #   there isn't one up.
+        with self._start_lock:
+            with self._lock:
+                if self._service is not None:
+                    return self._service, self._generation
+
+            generation = next(self._generations)
+            options = self.api.SessionOptions()
+            options.setServerHost(self.host)
+            options.setServerPort(self.port)
+
+            print("Connecting to %s:%s" % (self.host, self.port))
+            session = self.api.Session(
+                options,
+                lambda event, session: self._handle(event, generation)
+            )
+            if not session.start():
+                raise BloombergError("Failed to start session.")
+            if not session.openService(self.service_name):
+                session.stop()
+                raise BloombergError("Failed to open " + self.service_name)
+
+            with self._lock:
+                self._session = session
+                self._service = session.getService(self.service_name)
+                self._generation = generation
+                return self._service, generation
+
+    def stop(self):
+        with self._lock:
+            generation = self._generation
+        if generation is not None:
+            self._reset(generation, SessionLost("Session stopped."))
+
+    def send(self, request_type, params, on_message):
+        # Sends a request_type request filled in from params, then calls
+        #   on_message with each message of its response (on blpapi's event
+        #   thread) and returns once the response is complete. In params,
+        #   lists are appended to the element of that name; anything else
+        #   is set as it is.
+        service, generation = self.service()
+        request = service.createRequest(request_type)
+        for name, value in params.items():
+            if isinstance(value, (list, tuple)):
+                element = request.getElement(name)
+                for item in value:
+                    element.appendValue(item)
+            else:
+                request.set(name, value)
+
+        request_id = next(self._request_ids)
+        pending = _Pending(on_message, generation)
+        with self._lock:
+            if generation != self._generation:
+                raise SessionLost("Session went down.")
+            self._pending[request_id] = pending
+            session = self._session
+
+        try:
+            try:
+                session.sendRequest(
+                    request, correlationId=self.api.CorrelationId(request_id)
+                )
+            except Exception as e:
+                self._reset(generation, SessionLost(repr(e)))
+            if not pending.done.wait(self.timeout):
+                self._reset(generation, SessionLost(
+                    "No response in " + str(self.timeout) + " seconds."
+                ))
+        finally:
+            with self._lock:
+                self._pending.pop(request_id, None)
+
+        if pending.error is not None:
+            raise pending.error
+
+    def request(self, request_type, params, parse, on_result=None):
+        # Sends a request (see send) and returns [parse(message) for each
+        #   message of its response]. If given, on_result is called with
+        #   each of those as its message comes in. Identical requests (same
+        #   request_type, params and parse) made while it's waiting get the
+        #   same list back, without calling their on_result. If the session
+        #   goes down first, the request is resent on a new one, up to
+        #   retries times.
+        key = (request_type, _freeze(params), parse)
+        with self._lock:
+            future = self._in_flight.get(key)
+            if future is not None:
+                sender = False
+            else:
+                sender = True
+                future = self._in_flight[key] = Future()
+        if not sender:
+            return future.result()
+
+        try:
+            for attempt in range(self.retries + 1):
+                results = []
+                try:
+                    self.send(request_type, params,
+                              lambda message, results=results:
+                              self._parse(message, parse, on_result,
+                                          results))
+                    break
+                except SessionLost:
+                    if attempt == self.retries:
+                        raise
+            future.set_result(results)
+            return results
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+
+    @staticmethod
+    def _parse(message, parse, on_result, results):
+        result = parse(message)
+        results.append(result)
+        if on_result is not None:
+            on_result(result)
+
+    def _handle(self, event, generation):
+        # blpapi's event handler, called on its event thread.
+        event_type = event.eventType()
+        if event_type == self.api.Event.SESSION_STATUS:
+            for message in event:
+                if str(message.messageType()) == "SessionTerminated":
+                    self._reset(generation, SessionLost(str(message)),
+                                stop=False)
+            return
+        if event_type not in (self.api.Event.PARTIAL_RESPONSE,
+                              self.api.Event.RESPONSE,
+                              self.api.Event.REQUEST_STATUS):
+            return
+
+        answered = []
+        for message in event:
+            for correlation_id in message.correlationIds():
+                with self._lock:
+                    pending = self._pending.get(correlation_id.value())
+                if pending is None or pending.done.is_set():
+                    continue
+                if event_type == self.api.Event.REQUEST_STATUS:
+                    # RequestFailure
+                    pending.fail(BloombergError(str(message)))
+                    continue
+                try:
+                    pending.on_message(message)
+                except Exception as e:
+                    pending.fail(e)
+                answered.append(pending)
+        if event_type == self.api.Event.RESPONSE:
+            # That was the last of their responses
+            for pending in answered:
+                pending.done.set()
+
+    def _reset(self, generation, error, stop=True):
+        # Drops session generation (if it's still the current one) and fails
+        #   whatever was waiting on it with error.
+        with self._lock:
+            if generation != self._generation:
+                return
+            session = self._session
+            self._session = self._service = self._generation = None
+            waiting = [pending for pending in self._pending.values()
+                       if pending.generation == generation]
+        for pending in waiting:
+            pending.fail(error)
+        if stop and session is not None:
+            try:
+                session.stop()
+            except Exception:
+                pass
+
+def _freeze(params):
+    return tuple(sorted(
+        (name, tuple(value) if isinstance(value, (list, tuple)) else value)
+        for name, value in params.items()
+    ))
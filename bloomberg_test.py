@@ -5,77 +5,20 @@ from bloomberg_functions import *
 def main():
     options = parseCmdLine()
 
-    # Fill SessionOptions
-    sessionOptions = blpapi.SessionOptions()
-    sessionOptions.setServerHost(options.host)
-    sessionOptions.setServerPort(options.port)
-
-    print("Connecting to %s:%s" % (options.host, options.port))
-    # Create a Session
-    session = blpapi.Session(sessionOptions)
-
-    # Start a Session
-    if not session.start():
-        print("Failed to start session.")
-        return
+    # Connect to the server given on the command line
+    BLOOMBERG.host = options.host
+    BLOOMBERG.port = options.port
 
     try:
-        # Open service to get historical data from
-        if not session.openService("//blp/refdata"):
-            print("Failed to open //blp/refdata")
-            return
-
-        # Obtain previously opened service
-        refDataService = session.getService("//blp/refdata")
-
-        bbg_identifier = "IVV US Equity"
-
-        # Create and fill the request for the historical data
-        request = refDataService.createRequest("HistoricalDataRequest")
-        request.getElement("securities").appendValue(bbg_identifier)
-        request.getElement("fields").appendValue("OPEN")
-        request.getElement("fields").appendValue("HIGH")
-        request.getElement("fields").appendValue("LOW")
-        request.getElement("fields").appendValue("PX_LAST")
-        request.getElement("fields").appendValue("EQY_WEIGHTED_AVG_PX")
-        request.set("periodicityAdjustment", "ACTUAL")
-        request.set("periodicitySelection", "DAILY")
-        request.set("startDate", "20210326")
-        request.set("endDate", "20210330")
-        request.set("maxDataPoints", 1400) # Don't adjust please :)
-
-        print("Sending Request:", request)
-        # Send the request
-        session.sendRequest(request)
-
-        # Process received events
-        while(True):
-            # We provide timeout to give the chance for Ctrl+C handling:
-            ev = session.nextEvent(500)
-            for msg in ev:
-                if str(msg.messageType()) == "HistoricalDataResponse":
-
-                    histdata = []
-
-                    for fd in msg.getElement("securityData").getElement(
-                        "fieldData").values():
-                        histdata.append([fd.getElementAsString("date"), \
-                        fd.getElementAsFloat("OPEN"), fd.getElementAsFloat(
-                            "HIGH"), fd.getElementAsFloat("LOW"), \
-                        fd.getElementAsFloat("PX_LAST"), \
-                        fd.getElementAsFloat("EQY_WEIGHTED_AVG_PX")])
-
-                    histdata = pd.DataFrame(histdata, columns=["Date",
-                                                               "Open",
-                                                               "High", "Low",
-                                                               "Close", "VWAP"])
-
-            if ev.eventType() == blpapi.Event.RESPONSE:
-                # Response completely received, so we could exit
-                return histdata
+        # Both securities' bars come back from the same request
+        hd, errors = fetch_history(["IVV US Equity", "SPY US Equity"],
+                                   "20210326", "20210330")
+        for bbg_identifier, error in errors.items():
+            print("Couldn't fetch " + bbg_identifier + ": " + error)
+        return hd
     finally:
         # Stop the session
-        session.stop()
+        BLOOMBERG.stop()
 
 if __name__ == "__main__":
     print("SimpleHistoryExample")
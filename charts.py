@@ -0,0 +1,123 @@
+# Level-of-detail figures for the app's price and yield charts.
+#
+# Plotting every bar of a long history makes huge figures that are slow to
+# send and to zoom. These functions draw at most max_points points: the
+# candlestick switches from daily to weekly, monthly, quarterly or yearly
+# bars as the visible date range grows, and the yield surface keeps every
+# k-th date. Pass the date range the user has zoomed into (from the graph's
+# relayoutData) to redraw just that window at the finest detail that fits.
+
+import plotly.graph_objects as go
+import pandas as pd
+
+from utils import to_years
+
+MAX_CANDLES = 1000
+MAX_SURFACE_DATES = 250
+
+# From finest to coarsest
+OHLC_FREQUENCIES = [('D', 'daily'), ('W', 'weekly'), ('M', 'monthly'),
+                    ('Q', 'quarterly'), ('A', 'yearly')]
+
+def relayout_x_range(relayout_data):
+    # The x range zoomed to in a graph's relayoutData, or None if it was
+    #   reset (or there's no zoom in it).
+    if not relayout_data or relayout_data.get('xaxis.autorange'):
+        return None
+    if 'xaxis.range[0]' in relayout_data:
+        return (relayout_data['xaxis.range[0]'],
+                relayout_data['xaxis.range[1]'])
+    if 'xaxis.range' in relayout_data:
+        return tuple(relayout_data['xaxis.range'])
+    return None
+
+def in_date_range(hist, date_range):
+    # Rows of hist (with a sorted 'Date' column) within date_range.
+    if date_range is None:
+        return hist
+    start, end = pd.to_datetime(date_range[0]), pd.to_datetime(date_range[1])
+    dates = hist['Date'].values
+    return hist.iloc[
+        dates.searchsorted(start.to_datetime64(), 'left'):
+        dates.searchsorted(end.to_datetime64(), 'right')
+    ]
+
+def resample_ohlc(hist, max_bars=MAX_CANDLES):
+    # Returns (bars, frequency name): hist as the finest of daily, weekly,
+    #   monthly, quarterly or yearly bars that gives at most max_bars bars.
+    for freq, name in OHLC_FREQUENCIES:
+        if freq == 'D':
+            if len(hist) <= max_bars:
+                return hist, name
+            continue
+        bars = hist.set_index('Date')[['Open', 'High', 'Low', 'Close']] \
+            .resample(freq) \
+            .agg({'Open': 'first', 'High': 'max', 'Low': 'min',
+                  'Close': 'last'}) \
+            .dropna() \
+            .reset_index()
+        if len(bars) <= max_bars:
+            return bars, name
+    return bars, name
+
+def candlestick_figure(hist, date_range=None, max_bars=MAX_CANDLES):
+    hist = in_date_range(hist, date_range)
+    bars, frequency = resample_ohlc(hist, max_bars)
+
+    fig = go.Figure(
+        data=[
+            go.Candlestick(
+                x=bars['Date'],
+                open=bars['Open'],
+                high=bars['High'],
+                low=bars['Low'],
+                close=bars['Close']
+            )
+        ]
+    )
+    fig.update_layout(
+        title=frequency.capitalize() + ' bars',
+        # The range slider would need every bar
+        xaxis_rangeslider_visible=False,
+        # Keep the user's zoom when the figure is redrawn
+        uirevision='candlestick'
+    )
+    if date_range is not None:
+        fig.update_xaxes(range=list(date_range))
+    return fig
+
+def decimate_dates(frame, max_dates=MAX_SURFACE_DATES):
+    # Every k-th row of frame (always including the last), for the smallest
+    #   k that leaves at most max_dates rows.
+    if len(frame) <= max_dates:
+        return frame
+    step = -(-len(frame) // max_dates)
+    rows = list(range(len(frame) - 1, -1, -step))[::-1]
+    return frame.iloc[rows]
+
+def yield_surface_figure(bonds_data, date_range=None,
+                         max_dates=MAX_SURFACE_DATES):
+    bonds_data = decimate_dates(in_date_range(bonds_data, date_range),
+                                max_dates)
+    maturity_columns = list(filter(lambda x: ' ' in x, bonds_data.columns))
+
+    fig = go.Figure(
+        data=[
+            go.Surface(
+                z=bonds_data[maturity_columns],
+                y=bonds_data.Date,
+                x=[to_years(cmt_colname) for cmt_colname in maturity_columns]
+            )
+        ]
+    )
+
+    fig.update_layout(
+        scene=dict(
+            xaxis_title='Maturity (years)',
+            yaxis_title='Date',
+            zaxis_title='APR (%)',
+            zaxis=dict(ticksuffix='%')
+        ),
+        uirevision='bonds-3d-graph'
+    )
+    return fig
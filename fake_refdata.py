@@ -0,0 +1,293 @@
+# A stand-in for the parts of blpapi this app uses, serving made-up daily
+# bars from //blp/refdata, so the app can be run (and the Bloomberg code
+# exercised) without a Bloomberg connection -- e.g. on a Mac. Set the
+# BLOOMBERG_API environment variable to 'fake' to use it instead of blpapi.
+#
+# Each security's bars are a random walk seeded by its name, so every
+# request for the same security and dates gets the same bars back. Requests
+# are answered after LATENCY seconds on the session's event thread, one
+# HistoricalDataResponse message per security: all but the last in
+# PARTIAL_RESPONSE events, the last in the RESPONSE event. Securities
+# without a yellow key (e.g. 'IVV' rather than 'IVV US Equity') come back
+# with a securityError. Session.terminate() makes the session drop, to see
+# what happens when a connection is lost.
+
+import queue
+import threading
+import zlib
+
+import numpy as np
+import pandas as pd
+
+LATENCY = 0.05
+
+# Bars before this date aren't served
+FIRST_DATE = '1990-01-01'
+
+class Event:
+    SESSION_STATUS = 2
+    SERVICE_STATUS = 9
+    PARTIAL_RESPONSE = 6
+    RESPONSE = 5
+    REQUEST_STATUS = 4
+    TIMEOUT = 10
+
+    def __init__(self, event_type, messages):
+        self._event_type = event_type
+        self._messages = messages
+
+    def eventType(self):
+        return self._event_type
+
+    def __iter__(self):
+        return iter(self._messages)
+
+class CorrelationId:
+    def __init__(self, value=None):
+        self._value = value
+
+    def value(self):
+        return self._value
+
+    def __repr__(self):
+        return 'CorrelationId(' + repr(self._value) + ')'
+
+class Element:
+    # A named value: a dict of sub-elements, a list of values or a scalar.
+    def __init__(self, name, value):
+        self._name = name
+        self._value = value
+
+    def name(self):
+        return self._name
+
+    def hasElement(self, name):
+        return isinstance(self._value, dict) and name in self._value
+
+    def getElement(self, name):
+        if not self.hasElement(name):
+            raise KeyError(self._name + ' has no element ' + name)
+        return Element(name, self._value[name])
+
+    def getElementAsString(self, name):
+        return str(self.getElement(name)._value)
+
+    def getElementAsFloat(self, name):
+        return float(self.getElement(name)._value)
+
+    def getElementAsInteger(self, name):
+        return int(self.getElement(name)._value)
+
+    def numValues(self):
+        return len(self._value) if isinstance(self._value, list) else 1
+
+    def getValue(self, index=0):
+        return self._value[index] if isinstance(self._value, list) \
+            else self._value
+
+    def elements(self):
+        return [Element(name, value) for name, value in self._value.items()]
+
+    def getValueAsElement(self, index=0):
+        return Element(self._name, self._value[index])
+
+    def values(self):
+        return [Element(self._name, value) for value in self._value]
+
+    def appendValue(self, value):
+        self._value.append(value)
+
+    def __str__(self):
+        return self._name + ' = ' + repr(self._value)
+
+class Message(Element):
+    def __init__(self, message_type, value, correlation_id=None):
+        super().__init__(message_type, value)
+        self._correlation_ids = \
+            [] if correlation_id is None else [correlation_id]
+
+    def messageType(self):
+        return self._name
+
+    def correlationIds(self):
+        return self._correlation_ids
+
+class Request:
+    def __init__(self, request_type):
+        self.request_type = request_type
+        self._elements = {'securities': [], 'fields': []}
+        self._settings = {}
+
+    def getElement(self, name):
+        return Element(name, self._elements.setdefault(name, []))
+
+    def set(self, name, value):
+        self._settings[name] = value
+
+    def get(self, name, default=None):
+        return self._settings.get(name, default)
+
+    def __str__(self):
+        return self.request_type + ' ' + repr(
+            dict(self._elements, **self._settings)
+        )
+
+class Service:
+    def __init__(self, name):
+        self._name = name
+
+    def name(self):
+        return self._name
+
+    def createRequest(self, request_type):
+        if request_type != 'HistoricalDataRequest':
+            raise ValueError(self._name + " doesn't fake " + request_type)
+        return Request(request_type)
+
+class SessionOptions:
+    def __init__(self):
+        self.host = 'localhost'
+        self.port = 8194
+
+    def setServerHost(self, host):
+        self.host = host
+
+    def setServerPort(self, port):
+        self.port = port
+
+class Session:
+    def __init__(self, options=None, eventHandler=None):
+        self.options = options or SessionOptions()
+        self._handler = eventHandler
+        self._events = queue.Queue()
+        self._started = False
+        self._dispatcher = None
+
+    def start(self):
+        self._started = True
+        if self._handler is not None:
+            self._dispatcher = threading.Thread(target=self._dispatch,
+                                                daemon=True)
+            self._dispatcher.start()
+        self._push(Event.SESSION_STATUS, [Message('SessionStarted', {})])
+        return True
+
+    def stop(self):
+        if self._started:
+            self._started = False
+            self._push(Event.SESSION_STATUS,
+                       [Message('SessionTerminated', {})])
+        if self._dispatcher is not None and \
+                self._dispatcher is not threading.current_thread():
+            self._dispatcher.join()
+
+    def terminate(self):
+        # Drops the session, as if the connection was lost.
+        self._started = False
+        self._push(Event.SESSION_STATUS, [Message('SessionTerminated', {})])
+
+    def openService(self, name):
+        if not self._started or name != '//blp/refdata':
+            return False
+        self._push(Event.SERVICE_STATUS, [Message('ServiceOpened', {})])
+        return True
+
+    def getService(self, name):
+        return Service(name)
+
+    def sendRequest(self, request, correlationId=None):
+        if not self._started:
+            raise RuntimeError('Session is not started.')
+        correlationId = correlationId or CorrelationId(id(request))
+        threading.Timer(
+            LATENCY, self._respond, (request, correlationId)
+        ).start()
+        return correlationId
+
+    def nextEvent(self, timeout=0):
+        try:
+            return self._events.get(timeout=(timeout / 1000) or None)
+        except queue.Empty:
+            return Event(Event.TIMEOUT, [])
+
+    def _respond(self, request, correlation_id):
+        if not self._started:
+            return
+        securities = request.getElement('securities')._value
+        messages = [
+            Message('HistoricalDataResponse',
+                    {'securityData': security_data(request, security,
+                                                   sequence)},
+                    correlation_id)
+            for sequence, security in enumerate(securities)
+        ]
+        for message in messages[:-1]:
+            self._push(Event.PARTIAL_RESPONSE, [message])
+        self._push(Event.RESPONSE, messages[-1:])
+
+    def _push(self, event_type, messages):
+        self._events.put(Event(event_type, messages))
+
+    def _dispatch(self):
+        while True:
+            event = self._events.get()
+            self._handler(event, self)
+            if event.eventType() == Event.SESSION_STATUS and any(
+                    message.messageType() == 'SessionTerminated'
+                    for message in event
+            ):
+                return
+
+def security_data(request, security, sequence):
+    # The securityData element of the response for one security.
+    data = {'security': security, 'sequenceNumber': sequence,
+            'fieldExceptions': [], 'fieldData': []}
+    if len(security.split()) < 2:
+        data['securityError'] = {'category': 'BAD_SEC',
+                                 'message': 'Unknown/Invalid security'}
+        return data
+
+    bars = fake_bars(security, request.get('startDate'),
+                     request.get('endDate'))
+    max_points = request.get('maxDataPoints')
+    if max_points:
+        # Bloomberg keeps the latest ones
+        bars = bars.iloc[-int(max_points):]
+
+    fields = request.getElement('fields')._value
+    columns = [field for field in fields if field in bars.columns]
+    data['fieldExceptions'] = [
+        {'fieldId': field,
+         'errorInfo': {'category': 'BAD_FLD', 'message': 'Invalid field'}}
+        for field in fields if field not in bars.columns
+    ]
+    dates = bars.index.strftime('%Y-%m-%d')
+    values = bars[columns].values
+    data['fieldData'] = [
+        dict(zip(['date'] + columns, [day] + list(row)))
+        for day, row in zip(dates, values)
+    ]
+    return data
+
+def fake_bars(security, start_date, end_date):
+    # Made-up daily bars for security, on weekdays from start_date to
+    #   end_date (YYYYMMDD), with Bloomberg's field names as columns.
+    end = pd.to_datetime(end_date)
+    days = np.arange(np.datetime64(FIRST_DATE, 'D'),
+                     np.datetime64(end.date(), 'D') + 1)
+    days = pd.DatetimeIndex(days[np.is_busday(days)])
+    rng = np.random.default_rng(zlib.crc32(security.encode()))
+    returns = rng.normal(0.0003, 0.01, len(days))
+    close = 100 * np.exp(np.cumsum(returns))
+    open_ = close * np.exp(-returns * rng.uniform(0, 1, len(days)))
+    high = np.maximum(open_, close) * (1 + rng.uniform(0, 0.005, len(days)))
+    low = np.minimum(open_, close) * (1 - rng.uniform(0, 0.005, len(days)))
+    bars = pd.DataFrame({
+        'OPEN': open_,
+        'HIGH': high,
+        'LOW': low,
+        'PX_LAST': close,
+        'EQY_WEIGHTED_AVG_PX': (high + low + close) / 3,
+        'PX_VOLUME': rng.integers(10 ** 5, 10 ** 7, len(days)).astype(float)
+    }, index=days).round(4)
+    return bars.loc[pd.to_datetime(start_date):end]
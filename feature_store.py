@@ -0,0 +1,96 @@
+# On-disk cache for the parts of the backtest that only depend on the data.
+#
+# The yield curve fits only depend on the CMT rates, the vol features on the
+# IVV history and N, and the responses on both histories, N, n and alpha --
+# none of them on lot_size, starting_cash or start_date. A FeatureStore keeps
+# each of those frames in its own Feather file under root, named by a hash of
+# exactly the inputs it depends on, so rerunning the backtest with other
+# trading parameters (or another n, which still reuses both feature frames)
+# reads them back instead of recomputing them.
+#
+# Once the files add up to more than max_bytes, the least recently used ones
+# are deleted. Feather needs pyarrow.
+
+import hashlib
+import os
+import uuid
+
+import pandas as pd
+
+class FeatureStore:
+    def __init__(self, root, max_bytes=2 ** 30):
+        self.root = root
+        self.max_bytes = max_bytes
+        os.makedirs(root, exist_ok=True)
+
+    @staticmethod
+    def digest(frame):
+        # Hash of a DataFrame's column names, dtypes and values.
+        h = hashlib.sha256()
+        h.update(repr(list(zip(frame.columns, frame.dtypes.astype(str))))
+                 .encode())
+        h.update(pd.util.hash_pandas_object(frame, index=False).values
+                 .tobytes())
+        return h.hexdigest()
+
+    def key(self, kind, *parts):
+        # Name of the entry for a frame of the given kind computed from
+        #   parts (digests and parameters).
+        return kind + '-' + hashlib.sha256(
+            repr((kind,) + parts).encode()
+        ).hexdigest()[:32]
+
+    def path(self, key):
+        return os.path.join(self.root, key + '.feather')
+
+    def get(self, key):
+        # The stored frame, or None if there isn't one.
+        path = self.path(key)
+        try:
+            frame = pd.read_feather(path)
+        except FileNotFoundError:
+            return None
+        # Reading counts as a use
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return frame
+
+    def put(self, key, frame):
+        # Written under a temporary name and renamed, so that concurrent
+        # readers never see half a file.
+        path = self.path(key)
+        tmp_path = path + '.' + uuid.uuid4().hex[:8] + '.tmp'
+        frame.reset_index(drop=True).to_feather(tmp_path)
+        os.replace(tmp_path, path)
+        self.evict()
+
+    def get_or_compute(self, key, compute):
+        frame = self.get(key)
+        if frame is None:
+            frame = compute()
+            self.put(key, frame)
+        return frame
+
+    def evict(self):
+        # Deletes least recently used entries until the store fits in
+        #   max_bytes.
+        entries = []
+        for entry in os.scandir(self.root):
+            if entry.name.endswith('.feather'):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
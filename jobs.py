@@ -0,0 +1,125 @@
+# Runs long tasks (backtests) on background threads, so that Dash callbacks
+# can return right away and poll for progress instead of blocking a worker.
+#
+# JobManager needs no broker or extra process: jobs run on a thread pool in
+# the server process and are looked up by ID. Cancellation is cooperative --
+# a job stops at the next stage or model chunk after cancel() is called,
+# which it notices through the JobProgress it passes as the pipeline's
+# profiler.
+
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from profiling import NULL_PROFILER
+
+class JobCancelled(Exception):
+    pass
+
+class Job:
+    def __init__(self):
+        self.id = uuid.uuid4().hex
+        self.status = 'queued'
+        self.progress = 'queued'
+        self.result = None
+        self.error = None
+        self._cancelled = threading.Event()
+
+    @property
+    def finished(self):
+        return self.status in ('done', 'failed', 'cancelled')
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def check_cancelled(self):
+        if self.cancelled:
+            raise JobCancelled()
+
+class JobProgress:
+    # A profiler that reports each stage (and each chunk of model fits) as
+    #   the job's progress and stops the job if it has been cancelled.
+    #   Everything is passed on to profiler too.
+    def __init__(self, job, profiler=NULL_PROFILER):
+        self.job = job
+        self.profiler = profiler
+        self.stage_name = None
+        self.done = 0
+        self.total = None
+
+    @contextmanager
+    def stage(self, name, rows=None):
+        self.job.check_cancelled()
+        self.stage_name, self.done, self.total = name, 0, rows
+        self._report()
+        with self.profiler.stage(name, rows):
+            yield
+
+    def count(self, name, k=1):
+        self.profiler.count(name, k)
+        if name == 'model_days':
+            self.done += int(k)
+            self._report()
+            self.job.check_cancelled()
+
+    def _report(self):
+        progress = self.stage_name.replace('_', ' ')
+        if self.done and self.total:
+            progress += ' ' + str(self.done) + '/' + str(self.total) + ' days'
+        self.job.progress = progress
+
+class JobManager:
+    def __init__(self, max_workers=4, max_finished=64):
+        self.max_finished = max_finished
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix='job'
+        )
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def submit(self, fn, *args, **kwargs):
+        # Runs fn(job, *args, **kwargs) in the background and returns the
+        #   Job; its result ends up in job.result.
+        job = Job()
+        with self._lock:
+            self._jobs[job.id] = job
+            self._forget_finished()
+        self._executor.submit(self._run, job, fn, args, kwargs)
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def cancel(self, job_id):
+        job = self.get(job_id)
+        if job is not None and not job.finished:
+            job.cancel()
+
+    def _run(self, job, fn, args, kwargs):
+        if job.cancelled:
+            job.status = job.progress = 'cancelled'
+            return
+        job.status = 'running'
+        job.progress = 'starting'
+        try:
+            job.result = fn(job, *args, **kwargs)
+            job.status = job.progress = 'done'
+        except JobCancelled:
+            job.status = job.progress = 'cancelled'
+        except Exception as e:
+            job.error = e
+            job.status = 'failed'
+            job.progress = 'failed: ' + repr(e)
+
+    def _forget_finished(self):
+        # Keeps the max_finished most recent finished jobs
+        finished = [job_id for job_id, job in self._jobs.items()
+                    if job.finished]
+        for job_id in finished[:max(len(finished) - self.max_finished, 0)]:
+            del self._jobs[job_id]
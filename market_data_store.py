@@ -0,0 +1,333 @@
+# Local store of daily OHLC + VWAP bars, one folder per ticker in bbg_data.
+#
+# Each column of a ticker's history is a flat binary file of fixed-size
+# values (Date as days since 1970, prices as float64) in date order, so:
+#   - a date range is found by binary search on the dates and read as a
+#     slice of each column, without reading the rest of the file,
+#   - new bars are appended to the end of the files, and
+#   - the files can be memory mapped, so repeat reads of a ticker come
+#     straight from the page cache.
+# A ticker that only has a bbg_data/<ticker>.csv (the format this app used
+# to keep) is imported from it the first time it's read.
+#
+# Anything other than an append writes the whole history to a new version
+# folder inside the ticker's folder and then points the ticker's 'current'
+# file at it, so files that readers still have memory mapped are never
+# renamed or replaced (which Windows doesn't allow). Old versions are
+# deleted once they can be.
+#
+# Since there are no bars on weekends and holidays, the bars alone don't say
+# which dates have been fetched. Each ticker's folder also has a
+# coverage.json listing the date ranges its bars are complete for, so that
+# only the missing ranges need to be fetched.
+
+import json
+import os
+import shutil
+import threading
+import uuid
+from datetime import date, timedelta
+
+import numpy as np
+import pandas as pd
+
+MARKET_DATA_DIR = 'bbg_data'
+
+# Column -> how it's stored
+COLUMNS = {
+    'Date': np.dtype('datetime64[D]'),
+    'Open': np.dtype(np.float64),
+    'High': np.dtype(np.float64),
+    'Low': np.dtype(np.float64),
+    'Close': np.dtype(np.float64),
+    'VWAP': np.dtype(np.float64)
+}
+
+class MarketDataStore:
+    def __init__(self, root=MARKET_DATA_DIR, mmap=True):
+        self.root = root
+        self.mmap = mmap
+        # ticker -> (Date file's (inode, size, mtime), {column: array})
+        self._open = {}
+        self._lock = threading.RLock()
+
+    def ticker_dir(self, ticker):
+        return os.path.join(self.root, ticker)
+
+    def data_dir(self, ticker):
+        # The folder ticker's column files are in: the version named in its
+        #   'current' file, or the ticker's folder itself if there's none.
+        ticker_dir = self.ticker_dir(ticker)
+        try:
+            with open(os.path.join(ticker_dir, 'current')) as f:
+                return os.path.join(ticker_dir, f.read().strip())
+        except FileNotFoundError:
+            return ticker_dir
+
+    def _path(self, ticker, column, data_dir=None):
+        return os.path.join(data_dir or self.data_dir(ticker),
+                            column + '.bin')
+
+    def columns(self, ticker):
+        # {column: array} of everything stored for ticker (memory mapped if
+        #   self.mmap), or None if there's nothing.
+        with self._lock:
+            data_dir = self.data_dir(ticker)
+            try:
+                stat = os.stat(self._path(ticker, 'Date', data_dir))
+            except FileNotFoundError:
+                if not self._import_csv(ticker):
+                    return None
+                data_dir = self.data_dir(ticker)
+                stat = os.stat(self._path(ticker, 'Date', data_dir))
+
+            version = (data_dir, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+            cached = self._open.get(ticker)
+            if cached is not None and cached[0] == version:
+                return cached[1]
+
+            # The Date file is written last, so every other column has at
+            # least as many values
+            n_rows = stat.st_size // COLUMNS['Date'].itemsize
+            columns = {
+                column: self._read_column(data_dir, column, dtype, n_rows)
+                for column, dtype in COLUMNS.items()
+            }
+            self._open[ticker] = (version, columns)
+            return columns
+
+    def _read_column(self, data_dir, column, dtype, n_rows):
+        if n_rows == 0:
+            return np.zeros(0, dtype=dtype)
+        path = os.path.join(data_dir, column + '.bin')
+        if self.mmap:
+            return np.memmap(path, dtype=dtype, mode='r', shape=(n_rows,))
+        return np.fromfile(path, dtype=dtype, count=n_rows)
+
+    def date_range(self, ticker):
+        # (first date, last date) stored for ticker, or None.
+        columns = self.columns(ticker)
+        if columns is None or len(columns['Date']) == 0:
+            return None
+        return (pd.Timestamp(columns['Date'][0]),
+                pd.Timestamp(columns['Date'][-1]))
+
+    def read_arrays(self, ticker, start_date=None, end_date=None):
+        # ticker's bars from start_date to end_date (inclusive) as
+        #   {column: array}, without copying them out of the store, or None
+        #   if nothing is stored for ticker.
+        columns = self.columns(ticker)
+        if columns is None:
+            return None
+
+        dates = columns['Date']
+        first, last = 0, len(dates)
+        if start_date is not None:
+            first = dates.searchsorted(
+                np.datetime64(pd.Timestamp(start_date).date(), 'D'), 'left'
+            )
+        if end_date is not None:
+            last = dates.searchsorted(
+                np.datetime64(pd.Timestamp(end_date).date(), 'D'), 'right'
+            )
+
+        return {column: values[first:last]
+                for column, values in columns.items()}
+
+    def read(self, ticker, start_date=None, end_date=None):
+        # Same as read_arrays, but as a DataFrame of copies.
+        bars = self.read_arrays(ticker, start_date, end_date)
+        if bars is None:
+            return None
+        bars = {column: np.array(values) for column, values in bars.items()}
+        bars['Date'] = bars['Date'].astype('datetime64[ns]')
+        return pd.DataFrame(bars)
+
+    def write(self, ticker, bars):
+        # Adds bars (a DataFrame with a 'Date' column and some of the other
+        #   COLUMNS) to ticker's history; bars on dates already stored
+        #   replace them. Bars after the last stored date are appended;
+        #   anything else rewrites the ticker's files.
+        bars = self._to_columns(bars)
+        if len(bars['Date']) == 0:
+            return
+        with self._lock:
+            stored = self.columns(ticker)
+            if stored is None or len(stored['Date']) == 0 or \
+                    self._already_stored(stored, bars):
+                self.append(ticker, bars)
+                return
+
+            merged = pd.concat([
+                pd.DataFrame(bars),
+                pd.DataFrame({c: np.asarray(v) for c, v in stored.items()})
+            ]).drop_duplicates('Date').sort_values('Date')
+            self._rewrite(ticker, self._to_columns(merged))
+
+    def append(self, ticker, bars):
+        # Appends the bars dated after the last stored date.
+        bars = self._to_columns(bars)
+        with self._lock:
+            date_range = self.date_range(ticker)
+            if date_range is not None:
+                new = bars['Date'] > np.datetime64(date_range[1].date(), 'D')
+                bars = {column: values[new] for column, values in bars.items()}
+            self._append(ticker, bars)
+
+    @staticmethod
+    def _already_stored(stored, bars):
+        # Whether every bar of bars on or before the last stored date is
+        #   stored as is, e.g. when an update starts at the last stored day.
+        n_old = bars['Date'].searchsorted(stored['Date'][-1], 'right')
+        if n_old == 0:
+            return True
+        rows = stored['Date'].searchsorted(bars['Date'][:n_old])
+        if (rows >= len(stored['Date'])).any() or \
+                (stored['Date'][rows] != bars['Date'][:n_old]).any():
+            return False
+        return all(
+            np.array_equal(stored[column][rows], bars[column][:n_old],
+                           equal_nan=True)
+            for column in COLUMNS if column != 'Date'
+        )
+
+    @staticmethod
+    def _to_columns(bars):
+        bars = pd.DataFrame(bars)
+        dates = pd.to_datetime(bars['Date']).values.astype('datetime64[D]')
+        order = np.argsort(dates, kind='stable')
+        # Keep the last of any repeated dates
+        keep = np.ones(len(order), dtype=bool)
+        keep[:-1] = dates[order][1:] != dates[order][:-1]
+        order = order[keep]
+
+        columns = {'Date': dates[order]}
+        for column, dtype in COLUMNS.items():
+            if column == 'Date':
+                continue
+            if column in bars:
+                values = bars[column].values.astype(dtype)
+            else:
+                values = np.full(len(bars), np.nan, dtype=dtype)
+            columns[column] = values[order]
+        return columns
+
+    def _append(self, ticker, bars):
+        if len(bars['Date']) == 0:
+            return
+        data_dir = self.data_dir(ticker)
+        date_path = self._path(ticker, 'Date', data_dir)
+        if not os.path.isfile(date_path):
+            self._rewrite(ticker, bars)
+            return
+
+        # Cut off anything a failed append left past the last date, so that
+        # the new values line up with their dates
+        n_rows = os.path.getsize(date_path) // COLUMNS['Date'].itemsize
+        for column, dtype in COLUMNS.items():
+            path = self._path(ticker, column, data_dir)
+            if os.path.getsize(path) != n_rows * dtype.itemsize:
+                with open(path, 'r+b') as f:
+                    f.truncate(n_rows * dtype.itemsize)
+
+        # Dates last, so that readers never see a date without its prices
+        for column in list(COLUMNS.keys())[1:] + ['Date']:
+            with open(self._path(ticker, column, data_dir), 'ab') as f:
+                f.write(np.ascontiguousarray(bars[column]).tobytes())
+
+    def _rewrite(self, ticker, bars):
+        # Writes the whole history to a new version folder, then points
+        #   'current' at it.
+        ticker_dir = self.ticker_dir(ticker)
+        version = 'v' + uuid.uuid4().hex[:8]
+        new_dir = os.path.join(ticker_dir, version)
+        os.makedirs(new_dir)
+        for column in COLUMNS:
+            bars[column].tofile(self._path(ticker, column, new_dir))
+
+        self._open.pop(ticker, None)
+        current = os.path.join(ticker_dir, 'current')
+        tmp_path = current + '.' + uuid.uuid4().hex[:8] + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(version)
+        os.replace(tmp_path, current)
+        self._remove_old_versions(ticker, version)
+
+    def _remove_old_versions(self, ticker, version):
+        # Deletes ticker's column files other than version's. Files still
+        #   memory mapped somewhere can't be deleted on Windows; they're left
+        #   for a later rewrite to clean up.
+        ticker_dir = self.ticker_dir(ticker)
+        for entry in os.scandir(ticker_dir):
+            if entry.is_dir() and entry.name != version:
+                shutil.rmtree(entry.path, ignore_errors=True)
+            elif entry.name.endswith('.bin'):
+                try:
+                    os.remove(entry.path)
+                except OSError:
+                    pass
+
+    def _import_csv(self, ticker):
+        # Imports bbg_data/<ticker>.csv, if there is one.
+        csv_path = os.path.join(self.root, ticker + '.csv')
+        if not os.path.isfile(csv_path):
+            return False
+        with self._lock:
+            if not os.path.isfile(self._path(ticker, 'Date')):
+                bars = pd.read_csv(csv_path, parse_dates=['Date'])
+                self._rewrite(ticker, self._to_columns(bars))
+        return True
+
+    def _coverage_path(self, ticker):
+        return os.path.join(self.ticker_dir(ticker), 'coverage.json')
+
+    def coverage(self, ticker):
+        # Sorted, non-overlapping (first, last) date ranges that ticker's
+        #   bars are complete for. Without a coverage.json, that's taken to
+        #   be everything from the first stored bar to the last.
+        try:
+            with open(self._coverage_path(ticker)) as f:
+                return [(date.fromisoformat(first), date.fromisoformat(last))
+                        for first, last in json.load(f)]
+        except FileNotFoundError:
+            date_range = self.date_range(ticker)
+            if date_range is None:
+                return []
+            return [(date_range[0].date(), date_range[1].date())]
+
+    def add_coverage(self, ticker, first, last):
+        # Records that ticker's bars are complete from first to last.
+        first, last = pd.Timestamp(first).date(), pd.Timestamp(last).date()
+        with self._lock:
+            ranges = sorted(self.coverage(ticker) + [(first, last)])
+            merged = [ranges[0]]
+            for range_first, range_last in ranges[1:]:
+                if range_first <= merged[-1][1] + timedelta(days=1):
+                    merged[-1] = (merged[-1][0], max(merged[-1][1], range_last))
+                else:
+                    merged.append((range_first, range_last))
+
+            os.makedirs(self.ticker_dir(ticker), exist_ok=True)
+            path = self._coverage_path(ticker)
+            tmp_path = path + '.' + uuid.uuid4().hex[:8] + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump([[range_first.isoformat(), range_last.isoformat()]
+                           for range_first, range_last in merged], f)
+            os.replace(tmp_path, path)
+
+    def missing(self, ticker, first, last):
+        # The (first, last) date ranges between first and last that
+        #   ticker's bars aren't known to be complete for.
+        first, last = pd.Timestamp(first).date(), pd.Timestamp(last).date()
+        missing = []
+        for range_first, range_last in self.coverage(ticker):
+            if range_last < first:
+                continue
+            if range_first > last:
+                break
+            if range_first > first:
+                missing.append((first, range_first - timedelta(days=1)))
+            first = range_last + timedelta(days=1)
+        if first <= last:
+            missing.append((first, last))
+        return missing
@@ -0,0 +1,74 @@
+# For saving backtest results to disk.
+#
+# Nothing is written unless asked for. Results go into a directory of the
+# caller's choosing (new_run_dir makes a unique one per run so concurrent
+# runs don't clobber each other), in Parquet or Feather (both need pyarrow)
+# or CSV. With background=True the files are written on a writer thread and
+# a Future is returned right away.
+
+import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+RESULT_NAMES = [
+    'features_and_responses', 'blotter', 'calendar_ledger', 'trade_ledger'
+]
+FILE_FORMATS = ['parquet', 'feather', 'csv']
+
+# One writer thread, so that background writes happen in submission order.
+_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='results')
+
+def new_run_dir(base_dir):
+    # Returns a fresh directory under base_dir for one run's results, named
+    #   by start time plus a random suffix.
+    run_dir = os.path.join(
+        base_dir,
+        datetime.now().strftime('%Y%m%d-%H%M%S-') + uuid.uuid4().hex[:8]
+    )
+    os.makedirs(run_dir)
+    return run_dir
+
+def _write_frame(frame, path, file_format):
+    if file_format == 'parquet':
+        frame.to_parquet(path)
+    elif file_format == 'feather':
+        # feather only stores a default index
+        frame.reset_index(drop=True).to_feather(path)
+    else:
+        frame.to_csv(path)
+
+def _write_results(results, output_dir, file_format):
+    os.makedirs(output_dir, exist_ok=True)
+    paths = []
+    for name, frame in zip(RESULT_NAMES, results):
+        path = os.path.join(output_dir, name + '.' + file_format)
+        _write_frame(frame, path, file_format)
+        paths.append(path)
+    return paths
+
+def _report_failed_write(future):
+    # Nobody may be waiting on a background write, so make failures visible.
+    if future.exception() is not None:
+        print("Failed to write backtest results: " + repr(future.exception()))
+
+def write_results(
+        results, output_dir, file_format='parquet', background=False
+):
+    # Writes the four frames returned by backtest() into output_dir, one file
+    #   per frame. Returns the written paths, or a Future that resolves to
+    #   them if background is True.
+    if file_format not in FILE_FORMATS:
+        raise ValueError(
+            "file_format must be one of " + ", ".join(FILE_FORMATS) +
+            ", not '" + str(file_format) + "'"
+        )
+
+    if not background:
+        return _write_results(results, output_dir, file_format)
+
+    # Write copies, so the caller is free to modify the frames meanwhile.
+    results = [frame.copy() for frame in results]
+    future = _writer.submit(_write_results, results, output_dir, file_format)
+    future.add_done_callback(_report_failed_write)
+    return future
@@ -0,0 +1,183 @@
+# The backtest as a graph of stages that remembers its last run.
+#
+# Each stage declares which parameters and which earlier stages it reads.
+# BacktestPipeline.run() only recomputes the stages whose parameters or
+# upstream stages changed since the previous run, so e.g. a new starting_cash
+# only redoes the calendar ledger, and a new lot_size the blotter and
+# ledgers, while the features, responses and model fits are reused:
+#
+#   bond_features  <- bonds_hist
+#   vol_features   <- ivv_hist, N
+#   responses      <- bond_features, vol_features, ivv_hist, n, alpha
+#   decisions      <- responses, start_date, N, n
+#   blotter        <- responses, decisions, alpha, lot_size
+#   calendar_ledger <- blotter, ivv_hist, start_date, starting_cash
+#   trade_ledger   <- blotter, ivv_hist
+#
+# The last run is remembered separately for each pair of histories (up to
+# max_inputs of them, least recently used dropped first), so users
+# backtesting different tickers or date ranges don't evict each other's
+# stages. Runs on different histories go ahead in parallel; runs on the
+# same histories take turns.
+
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+from backtest import bond_features, build_blotter, build_calendar_ledger, \
+    build_trade_ledger, format_results, label_responses, \
+    rolling_trading_decisions, to_history_frame, vol_features, _stored
+from feature_store import FeatureStore
+from profiling import NULL_PROFILER
+
+def _bond_features(p, out, feature_store, profiler):
+    return _stored(
+        feature_store, ('bond_features', p['bonds_hist_digest']),
+        lambda: bond_features(p['bonds_hist'])
+    )
+
+def _vol_features(p, out, feature_store, profiler):
+    return _stored(
+        feature_store, ('vol_features', p['ivv_hist_digest'], p['N']),
+        lambda: vol_features(p['ivv_hist'], p['N'])
+    )
+
+def _responses(p, out, feature_store, profiler):
+    features = pd.merge(out['bond_features'], out['vol_features'], on='Date')
+    response = _stored(
+        feature_store,
+        ('responses', p['ivv_hist_digest'], p['bonds_hist_digest'], p['N'],
+         p['n'], p['alpha']),
+        lambda: label_responses(p['ivv_hist'], features['Date'], p['n'],
+                                p['alpha'])
+    )
+    return pd.concat([features, response], axis=1)
+
+def _decisions(p, out, feature_store, profiler):
+    features_and_responses = out['responses']
+    trading_positions = np.flatnonzero(
+        features_and_responses['Date'] >= p['start_date']
+    )
+    return trading_positions, rolling_trading_decisions(
+        'exit_date_long', 'long_success', features_and_responses,
+        trading_positions, p['N'], p['n'], profiler=profiler
+    )
+
+def _blotter(p, out, feature_store, profiler):
+    trading_positions, trade_decisions_long = out['decisions']
+    return build_blotter(
+        out['responses'], trading_positions, trade_decisions_long, p['alpha'],
+        p['lot_size']
+    )
+
+def _calendar_ledger(p, out, feature_store, profiler):
+    return build_calendar_ledger(
+        p['ivv_hist'], out['blotter'], p['start_date'], p['starting_cash']
+    )
+
+def _trade_ledger(p, out, feature_store, profiler):
+    return build_trade_ledger(p['ivv_hist'], out['blotter'])
+
+# (stage, function, parameters it reads, stages it reads), in run order.
+# The histories are compared by their digests.
+STAGES = [
+    ('bond_features', _bond_features, ['bonds_hist_digest'], []),
+    ('vol_features', _vol_features, ['ivv_hist_digest', 'N'], []),
+    ('responses', _responses, ['ivv_hist_digest', 'n', 'alpha'],
+     ['bond_features', 'vol_features']),
+    ('decisions', _decisions, ['start_date', 'N', 'n'], ['responses']),
+    ('blotter', _blotter, ['alpha', 'lot_size'], ['responses', 'decisions']),
+    ('calendar_ledger', _calendar_ledger,
+     ['ivv_hist_digest', 'start_date', 'starting_cash'], ['blotter']),
+    ('trade_ledger', _trade_ledger, ['ivv_hist_digest'], ['blotter'])
+]
+
+# How many rows each stage works through, for the profiler
+STAGE_ROWS = {
+    'bond_features': lambda p, out: len(p['bonds_hist']),
+    'vol_features': lambda p, out: len(p['ivv_hist']),
+    'responses': lambda p, out: len(out['vol_features']),
+    'decisions': lambda p, out: int(np.count_nonzero(
+        out['responses']['Date'] >= p['start_date']
+    )),
+    'blotter': lambda p, out: len(out['decisions'][0]),
+    'calendar_ledger': lambda p, out: len(p['ivv_hist']),
+    'trade_ledger': lambda p, out: len(out['blotter'])
+}
+
+class _Inputs:
+    # The stages last computed from one pair of histories.
+    def __init__(self):
+        self.versions = {}
+        self.outputs = {}
+        self.lock = threading.Lock()
+
+class BacktestPipeline:
+    def __init__(self, feature_store=None, max_inputs=8):
+        self.feature_store = feature_store
+        self.max_inputs = max_inputs
+        # (IVV digest, bonds digest) -> _Inputs, least recently used first
+        self._inputs = OrderedDict()
+        self.recomputed = []
+        self._lock = threading.Lock()
+
+    def run(
+            self, ivv_hist, bonds_hist, n, N, alpha, lot_size, start_date,
+            starting_cash, profiler=NULL_PROFILER
+    ):
+        # Same results as backtest.run_backtest(). The names of the stages
+        #   that had to be recomputed are left in self.recomputed (for the
+        #   run that finished last).
+        ivv_hist = to_history_frame(ivv_hist)
+        bonds_hist = to_history_frame(bonds_hist)
+
+        with profiler.stage(
+                'hash_inputs', rows=len(ivv_hist) + len(bonds_hist)
+        ):
+            params = {
+                'ivv_hist': ivv_hist,
+                'bonds_hist': bonds_hist,
+                'ivv_hist_digest': FeatureStore.digest(ivv_hist),
+                'bonds_hist_digest': FeatureStore.digest(bonds_hist),
+                'n': n, 'N': N, 'alpha': alpha, 'lot_size': lot_size,
+                'start_date': pd.to_datetime(start_date),
+                'starting_cash': starting_cash
+            }
+
+        key = (params['ivv_hist_digest'], params['bonds_hist_digest'])
+        with self._lock:
+            inputs = self._inputs.pop(key, None) or _Inputs()
+            self._inputs[key] = inputs
+            while len(self._inputs) > self.max_inputs:
+                self._inputs.popitem(last=False)
+
+        with inputs.lock:
+            versions, outputs = inputs.versions, inputs.outputs
+            recomputed = []
+            for name, compute, param_names, upstream in STAGES:
+                # A stage's version is what it was computed from
+                version = (
+                    tuple(params[p] for p in param_names),
+                    tuple(versions.get(s) for s in upstream)
+                )
+                if versions.get(name) != version:
+                    rows = STAGE_ROWS[name](params, outputs)
+                    with profiler.stage(name, rows=rows):
+                        outputs[name] = compute(
+                            params, outputs, self.feature_store, profiler
+                        )
+                    versions[name] = version
+                    recomputed.append(name)
+
+            results = (
+                outputs['responses'].copy(),
+                outputs['blotter'].copy(),
+                outputs['calendar_ledger'].copy(),
+                outputs['trade_ledger'].copy()
+            )
+        self.recomputed = recomputed
+
+        with profiler.stage('formatting'):
+            format_results(*results)
+        return results
@@ -0,0 +1,138 @@
+# Multi-asset version of the strategy: runs the same yield-curve + volatility
+# strategy over a whole universe of symbols at once and books every trade
+# into one combined portfolio.
+#
+# Prices are held as 2-D (date x symbol) arrays on a calendar shared by all
+# symbols, so the vol features, responses and per-symbol logistic regressions
+# for every symbol are computed together by the same functions backtest()
+# uses for IVV. Each symbol trades exactly as IVV does in backtest(): buy
+# lot_size shares at the next open when its model says so, and sell them when
+# the limit order fills or after n days.
+
+import numpy as np
+import pandas as pd
+from backtest import bond_features, response_arrays, \
+    rolling_decision_arrays, rolling_log_return_vol, to_history_frame
+from profiling import NULL_PROFILER
+
+PRICE_FIELDS = ['Open', 'High', 'Low', 'Close']
+
+def to_price_panel(histories):
+    # Lines up {symbol: OHLC history} (anything to_history_frame accepts) on
+    #   the dates every symbol has data for. Returns {field: DataFrame} with
+    #   a Date index and one column per symbol for each of PRICE_FIELDS.
+    histories = {
+        symbol: to_history_frame(hist).set_index('Date')
+        for symbol, hist in histories.items()
+    }
+    panel = pd.concat(
+        {symbol: hist[PRICE_FIELDS] for symbol, hist in histories.items()},
+        axis=1, join='inner'
+    ).sort_index()
+    return {
+        field: panel.xs(field, axis=1, level=1) for field in PRICE_FIELDS
+    }
+
+def portfolio_backtest(
+        prices, bonds_hist, n, N, alpha, lot_size, start_date, starting_cash,
+        chunk_size=4096, profiler=NULL_PROFILER
+):
+    # prices is a price panel like to_price_panel returns. Returns:
+    #   - decisions: 1/0 per trading date (rows) and symbol (columns)
+    #   - positions: shares held of each symbol on each day from start_date
+    #   - calendar_ledger: the combined portfolio's cash, stock value and
+    #     total value on each day from start_date
+    symbols = list(prices['Close'].columns)
+    dates = pd.to_datetime(prices['Close'].index).values
+    open_prices, high_prices, low_prices, close_prices = [
+        prices[field].values.astype(np.float64) for field in PRICE_FIELDS
+    ]
+
+    with profiler.stage('bond_features', rows=len(bonds_hist)):
+        bonds_features = bond_features(to_history_frame(bonds_hist))
+
+    with profiler.stage('vol_features', rows=close_prices.size):
+        vol = rolling_log_return_vol(close_prices, N)
+
+    # Features exist on the dates with both bond rates and N days of prices
+    with profiler.stage('merge', rows=len(bonds_features) + len(vol)):
+        features_dates, bond_idx, vol_idx = np.intersect1d(
+            bonds_features['Date'].values, dates[N:], return_indices=True
+        )
+        yield_curve = bonds_features[['a', 'b', 'R2']].values[bond_idx]
+        features = np.concatenate([
+            np.broadcast_to(
+                yield_curve[:, None, :], (len(features_dates), len(symbols), 3)
+            ),
+            vol[vol_idx][:, :, None]
+        ], axis=2)
+
+    with profiler.stage('responses', rows=len(features_dates) * len(symbols)):
+        response = response_arrays(
+            dates, open_prices, high_prices, low_prices, features_dates, n,
+            alpha
+        )
+        entry_price = response['entry_price'].round(2)
+        exit_price_long = response['exit_price_long'].round(2)
+
+    trading_positions = np.flatnonzero(
+        features_dates >= pd.to_datetime(start_date).to_datetime64()
+    )
+    with profiler.stage(
+            'model', rows=len(trading_positions) * len(symbols)
+    ):
+        decisions = rolling_decision_arrays(
+            features_dates, response['exit_date_long'],
+            response['long_success'], features, trading_positions, N, n,
+            chunk_size, profiler
+        )
+
+    with profiler.stage('calendar_ledger', rows=close_prices.size):
+        # Buys fill at the next open; the last features date's orders are
+        # still pending.
+        trade_rows, trade_symbols = np.nonzero(decisions == 1)
+        trade_rows = trading_positions[trade_rows]
+        filled = (trade_rows < len(features_dates) - 1) & \
+            response['has_data'][trade_rows]
+        trade_rows, trade_symbols = trade_rows[filled], trade_symbols[filled]
+
+        # Sells fill on the exit date, if it's known yet.
+        sold = response['known_long'][trade_rows, trade_symbols]
+
+        share_flows = np.zeros(close_prices.shape)
+        cash_flows = np.zeros(len(dates))
+        buy_idx = response['entry_idx'][trade_rows]
+        sell_idx = response['exit_idx_long'][trade_rows, trade_symbols][sold]
+        np.add.at(share_flows, (buy_idx, trade_symbols), lot_size)
+        np.add.at(share_flows, (sell_idx, trade_symbols[sold]), -lot_size)
+        np.add.at(
+            cash_flows, buy_idx,
+            -lot_size * entry_price[trade_rows, trade_symbols]
+        )
+        np.add.at(
+            cash_flows, sell_idx,
+            lot_size * exit_price_long[trade_rows, trade_symbols][sold]
+        )
+
+        in_range = dates >= pd.to_datetime(start_date).to_datetime64()
+        position = share_flows.cumsum(axis=0)[in_range]
+        cash = starting_cash + cash_flows.cumsum()[in_range]
+        stock_value = (position * close_prices[in_range]).sum(axis=1)
+
+    decisions = pd.DataFrame(
+        decisions, index=pd.Index(features_dates[trading_positions],
+                                  name='Date'),
+        columns=symbols
+    )
+    positions = pd.DataFrame(
+        position, index=pd.Index(dates[in_range], name='Date'),
+        columns=symbols
+    )
+    calendar_ledger = pd.DataFrame({
+        'Date': dates[in_range],
+        'cash': cash,
+        'stock_value': stock_value,
+        'total_value': cash + stock_value
+    })
+
+    return decisions, positions, calendar_ledger
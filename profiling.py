@@ -0,0 +1,112 @@
+# Stage-level instrumentation for the backtest pipeline.
+#
+# Pass a StageProfiler to backtest()/run_backtest() to record, for each
+# pipeline stage, wall time, CPU time, peak memory allocated while the stage
+# ran (via tracemalloc) and the number of rows it processed, plus counters
+# such as the number of models fit. Without one, the pipeline uses
+# NULL_PROFILER, whose methods do nothing.
+#
+# tracemalloc traces the whole process, so it's started when a stage traces
+# memory and stopped when no stage is tracing any more (unless something else
+# had already started it), so runs without a profiler don't pay for it after
+# one with a profiler. A stage's peak memory is only
+# recorded if no other stage traced memory while it ran (e.g. in another
+# backtest job running alongside it); otherwise its peak_mem_mb is None.
+
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+
+import pandas as pd
+
+_memory_lock = threading.Lock()
+# token -> whether another stage traced memory while it ran, for every stage
+# tracing memory now
+_memory_stages = {}
+# Whether _start_tracing_stage started tracemalloc, so should stop it
+_started_tracing = False
+
+def _start_tracing_stage():
+    global _started_tracing
+    with _memory_lock:
+        if not _memory_stages and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            _started_tracing = True
+        token = object()
+        if _memory_stages:
+            for other in _memory_stages:
+                _memory_stages[other] = True
+            _memory_stages[token] = True
+        else:
+            tracemalloc.reset_peak()
+            _memory_stages[token] = False
+        return token, tracemalloc.get_traced_memory()[0]
+
+def _end_tracing_stage(token, mem_start):
+    # The stage's peak memory in MB, or None if it overlapped another.
+    global _started_tracing
+    with _memory_lock:
+        if _memory_stages.pop(token):
+            peak_mem_mb = None
+        else:
+            peak_mem_mb = \
+                (tracemalloc.get_traced_memory()[1] - mem_start) / 2 ** 20
+        if not _memory_stages and _started_tracing:
+            tracemalloc.stop()
+            _started_tracing = False
+        return peak_mem_mb
+
+class StageProfiler:
+    def __init__(self, trace_memory=True):
+        self.trace_memory = trace_memory
+        self.stages = []
+        self.counters = {}
+
+    @contextmanager
+    def stage(self, name, rows=None):
+        if self.trace_memory:
+            token, mem_start = _start_tracing_stage()
+
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield
+        finally:
+            record = {
+                'stage': name,
+                'wall_s': time.perf_counter() - wall_start,
+                'cpu_s': time.process_time() - cpu_start,
+                'peak_mem_mb': None,
+                'rows': rows
+            }
+            if self.trace_memory:
+                record['peak_mem_mb'] = _end_tracing_stage(token, mem_start)
+            self.stages.append(record)
+
+    def count(self, name, k=1):
+        self.counters[name] = self.counters.get(name, 0) + int(k)
+
+    def report(self):
+        # JSON-ready summary of everything recorded so far.
+        return {
+            'stages': list(self.stages),
+            'counters': dict(self.counters),
+            'total_wall_s': sum(s['wall_s'] for s in self.stages),
+            'total_cpu_s': sum(s['cpu_s'] for s in self.stages)
+        }
+
+    def to_frame(self):
+        return pd.DataFrame(
+            self.stages,
+            columns=['stage', 'wall_s', 'cpu_s', 'peak_mem_mb', 'rows']
+        )
+
+class _NullProfiler:
+    def stage(self, name, rows=None):
+        return nullcontext()
+
+    def count(self, name, k=1):
+        pass
+
+NULL_PROFILER = _NullProfiler()
@@ -0,0 +1,39 @@
+# Server-side storage for the app's data and results.
+#
+# Instead of serializing DataFrames into hidden divs (and back out of them in
+# the next callback), the app keeps them in a ResultCache and only passes the
+# key that put() returns through the layout. The cache holds the max_entries
+# most recently used values; get() returns None for a key that has been
+# evicted, or that came from a server process that has since restarted.
+#
+# The cache lives in the server process, so the app must run as a single
+# process (threads are fine) for every callback to see the same cache.
+
+import threading
+import uuid
+from collections import OrderedDict
+
+class ResultCache:
+    def __init__(self, max_entries=32):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def put(self, value):
+        # Stores value and returns its key.
+        key = uuid.uuid4().hex
+        with self._lock:
+            self._entries[key] = value
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return key
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def __len__(self):
+        return len(self._entries)
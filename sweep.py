@@ -0,0 +1,192 @@
+# Parameter sweeps: runs the backtest over a grid of (n, N, alpha, lot_size)
+# values in a process pool and collects the app's performance metrics for
+# each parameter set.
+#
+# Inputs that don't depend on the grid (the IVV price history and the yield
+# curve features) are computed once in the parent process and placed in
+# shared memory, so workers read them in place instead of each receiving a
+# pickled copy. Workers hand those arrays straight to backtest's array-level
+# functions rather than building dataframes from them, which would copy them.
+# Within a worker, the decisions for a given (n, N, alpha) are reused across
+# all of the lot sizes.
+
+from itertools import product
+from multiprocessing import Pool, shared_memory
+import numpy as np
+import pandas as pd
+from backtest import MODEL_FEATURE_COLUMNS, RESPONSE_COLUMNS, \
+    bond_features, build_blotter, calendar_ledger_arrays, \
+    performance_metrics, response_arrays, rolling_decision_arrays, \
+    rolling_log_return_vol, to_history_frame, trade_ledger_arrays
+
+IVV_COLUMNS = ['Open', 'High', 'Low', 'Close']
+BOND_COLUMNS = ['a', 'b', 'R2']
+METRIC_COLUMNS = [
+    'alpha', 'beta', 'gmrr', 'avg_trades_per_yr', 'vol', 'sharpe', 'n_trades'
+]
+
+# Set in each worker by _init_worker
+_shared_blocks = []
+_ivv = None
+_bonds = None
+_sweep_args = None
+
+def _datetime_to_int64(dates):
+    return pd.to_datetime(dates).values.astype('datetime64[ns]').view('int64')
+
+def _to_shared(arrays):
+    # Copies each named array into its own shared memory block. Returns the
+    #   blocks (so the caller can release them) and the specs a worker needs
+    #   to attach to them.
+    blocks, specs = [], {}
+    for name, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        block = shared_memory.SharedMemory(
+            create=True, size=max(array.nbytes, 1)
+        )
+        np.ndarray(array.shape, array.dtype, buffer=block.buf)[:] = array
+        blocks.append(block)
+        specs[name] = (block.name, array.shape, array.dtype.str)
+    return blocks, specs
+
+def _from_shared(specs):
+    arrays = {}
+    for name, (block_name, shape, dtype) in specs.items():
+        block = shared_memory.SharedMemory(name=block_name)
+        _shared_blocks.append(block)
+        arrays[name] = np.ndarray(shape, np.dtype(dtype), buffer=block.buf)
+    return arrays
+
+def _init_worker(ivv_specs, bonds_specs, start_date, starting_cash):
+    global _ivv, _bonds, _sweep_args
+
+    _ivv = _from_shared(ivv_specs)
+    _ivv['Date'] = _ivv['Date'].view('datetime64[ns]')
+    _bonds = _from_shared(bonds_specs)
+    _bonds['Date'] = _bonds['Date'].view('datetime64[ns]')
+    _sweep_args = (start_date, starting_cash)
+
+def _run_parameter_set(task):
+    # Runs the backtest for one (n, N, alpha) and every lot size in the task,
+    #   returning one results row per lot size.
+    n, N, alpha, lot_sizes = task
+    start_date, starting_cash = _sweep_args
+    dates = _ivv['Date']
+
+    # The yield curve features and IVV vols on the dates that have both, as
+    # merging bond_features with vol_features would give.
+    features_dates, bond_rows, vol_rows = np.intersect1d(
+        _bonds['Date'], dates[N:], assume_unique=True, return_indices=True
+    )
+    features = {column: _bonds[column][bond_rows] for column in BOND_COLUMNS}
+    features['ivv_vol'] = rolling_log_return_vol(_ivv['Close'], N)[vol_rows]
+
+    response = response_arrays(
+        dates, _ivv['Open'], _ivv['High'], _ivv['Low'], features_dates, n,
+        alpha
+    )
+    # Rounded as label_responses does
+    response = {
+        column: response[column].round(2)
+        if response[column].dtype.kind == 'f' else response[column]
+        for column in RESPONSE_COLUMNS
+    }
+
+    trading_positions = np.flatnonzero(
+        features_dates >= np.datetime64(pd.to_datetime(start_date))
+    )
+    trade_decisions_long = rolling_decision_arrays(
+        features_dates, response['exit_date_long'][:, None],
+        response['long_success'][:, None],
+        np.column_stack(
+            [features[column] for column in MODEL_FEATURE_COLUMNS]
+        )[:, None, :],
+        trading_positions, N, n
+    )[:, 0]
+
+    features_and_responses = pd.DataFrame(
+        dict(Date=features_dates, **features, **response)
+    )
+
+    rows = []
+    for lot_size in lot_sizes:
+        blotter = build_blotter(
+            features_and_responses, trading_positions, trade_decisions_long,
+            alpha, lot_size
+        )
+        calendar_ledger = calendar_ledger_arrays(
+            dates, _ivv['Close'], blotter, start_date, starting_cash
+        )
+        trade_ledger = pd.DataFrame(
+            trade_ledger_arrays(dates, _ivv['Close'], blotter)
+        )
+
+        # The metrics need at least a couple of closed trades (after the
+        # most recent one is dropped) to be defined.
+        if len(trade_ledger) > 2:
+            metrics = performance_metrics(trade_ledger)
+        else:
+            metrics = dict.fromkeys(METRIC_COLUMNS[:-1], np.nan)
+        metrics['n_trades'] = len(trade_ledger)
+
+        rows.append(
+            [n, N, alpha, lot_size] + [metrics[k] for k in METRIC_COLUMNS] +
+            [calendar_ledger['total_value'][-1]]
+        )
+
+    return rows
+
+def sweep(
+        ivv_hist, bonds_hist, n_values, N_values, alpha_values,
+        lot_size_values, start_date, starting_cash, processes=None
+):
+    # Runs the backtest for every combination of the given n, N, alpha and
+    #   lot size values. ivv_hist and bonds_hist are the IVV and CMT rate
+    #   histories, in any form to_history_frame accepts.
+    #   Returns one row per parameter set with the app's performance metrics,
+    #   the number of closed trades, and the final total value.
+    ivv_hist = to_history_frame(ivv_hist)
+    bonds_hist = to_history_frame(bonds_hist)
+
+    # The yield curve features don't depend on any of the swept parameters.
+    bonds_features = bond_features(bonds_hist)
+
+    ivv_arrays = {'Date': _datetime_to_int64(ivv_hist['Date'])}
+    for column in IVV_COLUMNS:
+        ivv_arrays[column] = ivv_hist[column].values.astype(np.float64)
+    bonds_arrays = {'Date': _datetime_to_int64(bonds_features['Date'])}
+    for column in BOND_COLUMNS:
+        bonds_arrays[column] = bonds_features[column].values.astype(np.float64)
+
+    tasks = [
+        (n, N, alpha, list(lot_size_values))
+        for n, N, alpha in product(n_values, N_values, alpha_values)
+    ]
+
+    ivv_blocks, ivv_specs = _to_shared(ivv_arrays)
+    bonds_blocks, bonds_specs = _to_shared(bonds_arrays)
+    try:
+        with Pool(
+                processes, initializer=_init_worker,
+                initargs=(ivv_specs, bonds_specs, start_date, starting_cash)
+        ) as pool:
+            rows = [
+                row for task_rows in pool.imap_unordered(
+                    _run_parameter_set, tasks
+                ) for row in task_rows
+            ]
+    finally:
+        for block in ivv_blocks + bonds_blocks:
+            block.close()
+            block.unlink()
+
+    # 'alpha' is already taken by the parameter, so the metrics are named
+    # after the app's strategy-* outputs.
+    results = pd.DataFrame(
+        rows,
+        columns=['n', 'N', 'alpha', 'lot_size', 'strategy_alpha',
+                 'strategy_beta'] + METRIC_COLUMNS[2:] + ['final_total_value']
+    )
+    return results.sort_values(
+        ['n', 'N', 'alpha', 'lot_size']
+    ).reset_index(drop=True)
@@ -0,0 +1,102 @@
+# Server-side filtering, sorting and paging for the app's DataTables.
+#
+# The tables run with page_action, sort_action and filter_action set to
+# 'custom', so Dash sends the page the user is looking at, the sort_by list
+# and the filter_query string, and the server answers with just that page's
+# rows. query_frame does that against a result frame; the filter_query
+# syntax is Dash's, e.g. "{status} = FILLED && {fill_price} > 400".
+
+import operator
+import re
+
+import numpy as np
+import pandas as pd
+
+OPERATORS = [
+    (['ge ', '>='], operator.ge),
+    (['le ', '<='], operator.le),
+    (['lt ', '<'], operator.lt),
+    (['gt ', '>'], operator.gt),
+    (['ne ', '!='], operator.ne),
+    (['eq ', '='], operator.eq),
+    (['contains '], 'contains'),
+    (['datestartswith '], 'datestartswith')
+]
+
+_COLUMN = re.compile(r'\{(.*?)\}')
+
+def split_filter_part(filter_part):
+    # "{col} op value" -> (col, op, value); value is a float if it looks
+    #   like one, else a string with any quotes taken off. Returns
+    #   (None, None, None) for parts it can't read.
+    for names, op in OPERATORS:
+        for name in names:
+            if name not in filter_part:
+                continue
+            name_part, value_part = filter_part.split(name, 1)
+            column = _COLUMN.search(name_part)
+            if column is None:
+                continue
+
+            value = value_part.strip()
+            if value and value[0] == value[-1] and value[0] in "'\"`":
+                value = value[1:-1].replace('\\' + value[0], value[0])
+            else:
+                try:
+                    value = float(value)
+                except ValueError:
+                    pass
+            return column.group(1), op, value
+    return None, None, None
+
+def filter_mask(frame, filter_query):
+    # Boolean mask of the rows of frame that pass filter_query. Parts that
+    #   name unknown columns or can't be read are ignored.
+    mask = np.ones(len(frame), dtype=bool)
+    for filter_part in (filter_query or '').split(' && '):
+        column, op, value = split_filter_part(filter_part)
+        if column not in frame.columns:
+            continue
+        values = frame[column]
+
+        if op == 'contains':
+            mask &= values.astype(str).str.contains(
+                str(value), regex=False
+            ).values
+        elif op == 'datestartswith':
+            mask &= values.astype(str).str.startswith(str(value)).values
+        else:
+            if pd.api.types.is_object_dtype(values) and isinstance(value, str):
+                # Dates are shown (and typed) as YYYY-MM-DD
+                values = values.astype(str)
+            elif not pd.api.types.is_numeric_dtype(values):
+                values = values.astype(str)
+                value = str(value)
+            try:
+                mask &= np.asarray(op(values, value), dtype=bool)
+            except TypeError:
+                # e.g. a number column compared with text
+                continue
+    return mask
+
+def query_frame(frame, filter_query, sort_by, page_current, page_size):
+    # Returns (records of the requested page, number of pages) after
+    #   filtering frame by filter_query and sorting it by sort_by, a list of
+    #   {'column_id': ..., 'direction': 'asc' | 'desc'}. Only the rows on the
+    #   page are turned into records.
+    mask = filter_mask(frame, filter_query)
+    if not mask.all():
+        frame = frame[mask]
+
+    sort_by = [s for s in sort_by or [] if s['column_id'] in frame.columns]
+    if sort_by:
+        frame = frame.sort_values(
+            [s['column_id'] for s in sort_by],
+            ascending=[s['direction'] == 'asc' for s in sort_by],
+            kind='mergesort', na_position='last'
+        )
+
+    page_count = max(-(-len(frame) // page_size), 1)
+    page_current = min(page_current or 0, page_count - 1)
+    start = page_current * page_size
+    return frame.iloc[start:start + page_size].to_dict('records'), page_count
@@ -1,10 +1,23 @@
 # For utilities (helper functions)
 
+import os
+import threading
 import time
+from io import StringIO
 import pandas as pd
 import requests
 from bs4 import BeautifulSoup
 from datetime import date
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Where the Treasury's yearly CMT rate tables are fetched from. Point
+# USDT_RATES_URL at a local server replaying recorded pages to work offline.
+USDT_RATES_URL = os.environ.get(
+    'USDT_RATES_URL',
+    'https://www.treasury.gov/resource-center/data-chart-center/' +
+    'interest-rates/pages/TextView.aspx'
+)
 
 def date_to_str(date_obj, format = "%Y-%m-%d"):
     return date.strftime(pd.to_datetime(date_obj).date(), format)
@@ -17,24 +30,55 @@ def to_years(x):
         if str_split[1] == 'yr':
             return int(str_split[0])
 
-def fetch_usdt_rates(YYYY):
+def http_session(pool_size=8, retries=3, backoff_factor=0.5):
+    # A requests Session that keeps up to pool_size connections per host
+    #   open for reuse and retries failed requests (connection errors, 429s
+    #   and 5xx's) up to `retries` times, waiting backoff_factor * 2^k
+    #   seconds between tries.
+    retry = Retry(
+        total=retries, backoff_factor=backoff_factor,
+        status_forcelist=[429, 500, 502, 503, 504]
+    )
+    adapter = HTTPAdapter(
+        pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry
+    )
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+_usdt_session = None
+_usdt_session_lock = threading.Lock()
+
+def usdt_session():
+    # The Session shared by every fetch_usdt_rates call.
+    global _usdt_session
+    with _usdt_session_lock:
+        if _usdt_session is None:
+            _usdt_session = http_session()
+        return _usdt_session
+
+def parse_usdt_rates(html):
+    # The CMT rate table of a Treasury yield page as a DataFrame, with a
+    #   datetime 'Date' column and float rates (NaN where there's no rate).
+    df = pd.read_html(StringIO(html), attrs={'class': 't-chart'})[0]
+    df['Date'] = pd.to_datetime(df['Date'])
+    for column in df.columns.drop('Date'):
+        df[column] = pd.to_numeric(df[column], errors='coerce')
+    return df
+
+def fetch_usdt_rates(YYYY, session=None, url=None, timeout=30):
     # Requests the USDT's daily yield data for a given year. Results are
     #   returned as a DataFrame object with the 'Date' column formatted as a
     #   pandas datetime type.
-
-    URL = 'https://www.treasury.gov/resource-center/data-chart-center/' + \
-          'interest-rates/pages/TextView.aspx?data=yieldYear&year=' + str(YYYY)
-
-    cmt_rates_page = requests.get(URL)
-
-    soup = BeautifulSoup(cmt_rates_page.content, 'html.parser')
-
-    table_html = soup.findAll('table', {'class': 't-chart'})
-
-    df = pd.read_html(str(table_html))[0]
-    df.Date = pd.to_datetime(df.Date)
-
-    return df
+    response = (session or usdt_session()).get(
+        url or USDT_RATES_URL,
+        params={'data': 'yieldYear', 'year': str(YYYY)},
+        timeout=timeout
+    )
+    response.raise_for_status()
+
+    return parse_usdt_rates(response.text)
 
 def Y_m_d_to_unix_str(ymd_str):
     return str(int(time.mktime(pd.to_datetime(ymd_str).date().timetuple())))
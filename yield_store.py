@@ -0,0 +1,125 @@
+# Local copy of the US Treasury's daily CMT yield curve rates.
+#
+# Each year is kept in its own Feather file in usdt_data (next to bbg_data),
+# so reading a date range only touches local files. A year is fetched with
+# utils.fetch_usdt_rates the first time it's needed. After that it's only
+# fetched again while it's still changing -- i.e. if it was last fetched
+# before the year was over -- and then at most once every max_age. If the
+# Treasury can't be reached, whatever is stored locally is used instead.
+#
+# Stale years are fetched max_workers at a time, over fetch_usdt_rates'
+# shared connection pool. Pass another fetch_year (taking a year and
+# returning that year's rates as a DataFrame with a datetime 'Date' column)
+# to load from somewhere else. Fetches run without holding the store's lock,
+# so one slow download doesn't hold up readers of years already stored; the
+# lock only covers writing and reading the local files.
+
+import os
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+
+import pandas as pd
+
+from utils import fetch_usdt_rates
+
+YIELD_DATA_DIR = 'usdt_data'
+
+class YieldStore:
+    def __init__(self, root=YIELD_DATA_DIR, fetch_year=fetch_usdt_rates,
+                 max_age=timedelta(days=1), max_workers=4):
+        self.root = root
+        self.fetch_year = fetch_year
+        self.max_age = max_age
+        self.max_workers = max_workers
+        # year -> (rates, when they were fetched), for years read already
+        self._years = {}
+        self._lock = threading.Lock()
+
+    def path(self, year):
+        return os.path.join(self.root, str(year) + '.feather')
+
+    def fetched_at(self, year):
+        # When year was last fetched, or None if it never was.
+        try:
+            return datetime.fromtimestamp(os.path.getmtime(self.path(year)))
+        except FileNotFoundError:
+            return None
+
+    def is_stale(self, year, now=None):
+        fetched_at = self.fetched_at(year)
+        if fetched_at is None:
+            return True
+        if fetched_at.date() > date(year, 12, 31):
+            # Fetched after the year was over, so it won't change again
+            return False
+        return (now or datetime.now()) - fetched_at >= self.max_age
+
+    def refresh(self, years):
+        # Fetches whichever of years are stale, up to max_workers at once.
+        stale = [year for year in years if self.is_stale(year)]
+        if not stale:
+            return
+        with ThreadPoolExecutor(
+                max_workers=min(self.max_workers, len(stale))
+        ) as executor:
+            fetches = [(year, executor.submit(self.fetch_year, year))
+                       for year in stale]
+
+        for year, fetch in fetches:
+            try:
+                rates = fetch.result()
+                with self._lock:
+                    self._save(year, rates)
+            except Exception as e:
+                if self.fetched_at(year) is None:
+                    raise
+                print("Couldn't refresh " + str(year) + " CMT rates (" +
+                      repr(e) + "); using the local copy.")
+
+    def year(self, year):
+        # The rates for one year, from the local file unless it's stale.
+        self.refresh([year])
+        with self._lock:
+            return self._load(year)
+
+    def rates(self, start_date, end_date):
+        # The rates from start_date to end_date (inclusive). Empty if start_date
+    #   is after this year.
+        start_date = pd.to_datetime(start_date)
+        end_date = pd.to_datetime(end_date)
+        years = range(start_date.year,
+                      min(end_date.year, date.today().year) + 1)
+        if not years:
+            return pd.DataFrame({'Date': pd.Series(dtype='datetime64[ns]')})
+        self.refresh(years)
+        with self._lock:
+            rates = pd.concat(
+                [self._load(year) for year in years], ignore_index=True
+            )
+        dates = rates['Date'].values
+        return rates.iloc[
+            dates.searchsorted(start_date.to_datetime64(), 'left'):
+            dates.searchsorted(end_date.to_datetime64(), 'right')
+        ].reset_index(drop=True)
+
+    def _save(self, year, rates):
+        rates = rates.copy()
+        rates['Date'] = pd.to_datetime(rates['Date'])
+        rates = rates.sort_values('Date').reset_index(drop=True)
+
+        os.makedirs(self.root, exist_ok=True)
+        # Written under a temporary name and renamed, so that a failed write
+        # never leaves half a file behind.
+        tmp_path = self.path(year) + '.' + uuid.uuid4().hex[:8] + '.tmp'
+        rates.to_feather(tmp_path)
+        os.replace(tmp_path, self.path(year))
+
+    def _load(self, year):
+        fetched_at = self.fetched_at(year)
+        cached = self._years.get(year)
+        if cached is None or cached[1] != fetched_at:
+            cached = (pd.read_feather(self.path(year)), fetched_at)
+            self._years[year] = cached
+        return cached[0]